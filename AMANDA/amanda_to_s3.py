@@ -1,9 +1,14 @@
 """
-Queries the AMANDA read-replica DB and sents the result as a CSV in S3
+Queries the AMANDA read-replica DB and sents the result as a CSV in S3.
+Multiple queries can be run at once, sharing a pool of database connections.
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import csv
+from datetime import datetime, timedelta
 from io import StringIO
+import json
 import os
 import logging
 
@@ -11,6 +16,7 @@ import cx_Oracle
 import pandas as pd
 import boto3
 
+from common import s3_utils
 import utils
 
 # For local dev:
@@ -30,6 +36,16 @@ AWS_ACCESS_ID = os.getenv("EXEC_DASH_ACCESS_ID")
 AWS_PASS = os.getenv("EXEC_DASH_PASS")
 BUCKET = os.getenv("BUCKET_NAME")
 
+# pandas dtypes for database column types, so text columns are stored as text in Parquet files
+# even when they are empty or look like numbers. Other types are inferred from the values, so dates
+# outside the datetime64[ns] range, like the 9999-12-31 sentinel, fall back to a type that holds them.
+COLUMN_DTYPES = {
+    cx_Oracle.DB_TYPE_CHAR: "string",
+    cx_Oracle.DB_TYPE_NCHAR: "string",
+    cx_Oracle.DB_TYPE_VARCHAR: "string",
+    cx_Oracle.DB_TYPE_NVARCHAR: "string",
+}
+
 """
 Queries:
 
@@ -42,72 +58,98 @@ as a snapshot in time as permits will enter and leave the active status all the
 
 issued_permits: similar to applications_received but is now for counting those permits that were actually issued.
 
+applications_received_weekly and issued_permits_weekly: the same counts summed by type for each Sunday-Saturday week,
+labeled with the Saturday that ends the week. TRUNC(d + 1, 'IW') + 5 is used to find that Saturday since it does
+not depend on the database language settings.
+
 """
 
-QUERIES = {
-    "applications_received": """
+# Templates of the count queries. {date} is the date column that is counted, {where} picks the folders
+# that are counted, and {since} is an extra filter that incremental queries use, see count_query.
+DAILY_COUNT = """
     SELECT
         Foldertype,
         subcode,
-        TO_CHAR(ROUND(INDATE, 'DDD'), 'YYYY-MM-DD'),
+        TO_CHAR(ROUND({date}, 'DDD'), 'YYYY-MM-DD'),
         COUNT(1) IssuedROWPermits
     FROM
         folder
-    WHERE (foldertype in('DS')
-        AND STATUSCODE NOT IN(50005, 50003, 70045)
-        AND INDATE >= TO_DATE('10-01-2018', 'mm-dd-yyyy')
-        AND INDATE IS NOT NULL)
-        OR(foldertype in('RW', 'EX')
-            AND STATUSCODE NOT IN(70045, 50003)
-            AND INDATE >= TO_DATE('10-01-2018', 'mm-dd-yyyy')
-            AND SUBCODE NOT IN(50510, 50505)
-            AND INDATE IS NOT NULL)
+    WHERE ({where}){since}
     GROUP BY
-        TO_CHAR(ROUND(INDATE, 'DDD'), 'YYYY-MM-DD'),
+        TO_CHAR(ROUND({date}, 'DDD'), 'YYYY-MM-DD'),
         Foldertype,
         subcode
     ORDER BY
         Foldertype
-    """,
-    "active_permits": """
+    """
+
+WEEKLY_COUNT = """
     SELECT
         Foldertype,
-        COUNT(1) ACTIVEPERMITS
+        TO_CHAR(TRUNC(ROUND({date}, 'DDD') + 1, 'IW') + 5, 'YYYY-MM-DD') AS WEEK,
+        COUNT(1) IssuedROWPermits
     FROM
         folder
-    WHERE (foldertype in('EX', 'DS')
-        AND STATUSCODE IN(50010))
-        OR(foldertype in('RW')
-            AND STATUSCODE IN(50010)
-            AND FOLDERNAME NOT LIKE 'LA-%')
+    WHERE ({where}){since}
     GROUP BY
+        TO_CHAR(TRUNC(ROUND({date}, 'DDD') + 1, 'IW') + 5, 'YYYY-MM-DD'),
         Foldertype
     ORDER BY
         Foldertype
-    """,
-    "issued_permits": """
-    SELECT
-        Foldertype,
-        subcode,
-        TO_CHAR(ROUND(ISSUEDATE, 'DDD'), 'YYYY-MM-DD'),
-        COUNT(1) IssuedROWPermits
-    FROM
-        folder
-    WHERE (foldertype in('EX', 'DS')
+    """
+
+# The date column and folder filter of each count
+COUNTS = {
+    "applications_received": (
+        "INDATE",
+        """(foldertype in('DS')
+        AND STATUSCODE NOT IN(50005, 50003, 70045)
+        AND INDATE >= TO_DATE('10-01-2018', 'mm-dd-yyyy')
+        AND INDATE IS NOT NULL)
+        OR(foldertype in('RW', 'EX')
+            AND STATUSCODE NOT IN(70045, 50003)
+            AND INDATE >= TO_DATE('10-01-2018', 'mm-dd-yyyy')
+            AND SUBCODE NOT IN(50510, 50505)
+            AND INDATE IS NOT NULL)""",
+    ),
+    "issued_permits": (
+        "ISSUEDATE",
+        """(foldertype in('EX', 'DS')
         AND ISSUEDATE >= TO_DATE('10-01-2018', 'mm-dd-yyyy')
         AND ISSUEDATE IS NOT NULL)
         OR(foldertype in('RW')
             AND ISSUEDATE >= TO_DATE('10-01-2018', 'mm-dd-yyyy')
             AND SUBCODE NOT IN(50510, 50505)
-            AND ISSUEDATE IS NOT NULL)
-    GROUP BY
-        TO_CHAR(ROUND(ISSUEDATE, 'DDD'), 'YYYY-MM-DD'),
-        Foldertype,
-        subcode
-    ORDER BY
-        Foldertype
-    """,
-    "review_time": """
+            AND ISSUEDATE IS NOT NULL)""",
+    ),
+}
+
+
+def count_query(template, count, incremental=False):
+    """
+    Fills in a count query template for one of the COUNTS
+
+    Parameters
+    ----------
+    template : String, DAILY_COUNT or WEEKLY_COUNT
+    count : String, a key of COUNTS
+    incremental : bool, if True only the days on or after the :start_date bind variable are counted.
+        ROUND(x, 'DDD') rounds to the nearest day, so records from noon the day before the start date
+        are also included to make sure the first day's count is complete.
+
+    Returns
+    -------
+    String of the query
+
+    """
+    date, where = COUNTS[count]
+    since = f"\n        AND {date} >= :start_date - 0.5" if incremental else ""
+    return template.format(date=date, where=where, since=since)
+
+
+# Queries that can also be fetched in slices, see PARTITIONED_QUERIES.
+# {partition} is replaced by the filter of one slice, or nothing for the full query.
+REVIEW_TIME = """
     SELECT
         f.CUSTOMFOLDERNUMBER,
         f.FOLDERRSN,
@@ -128,9 +170,10 @@ QUERIES = {
         f.FOLDERTYPE = 'RW'
         AND f.SUBCODE = 50500
         AND f.WORKCODE = 50590
-        AND fa.RESULTCODE = 61510
-    """,
-    "ex_permits_issued": """
+        AND fa.RESULTCODE = 61510{partition}
+    """
+
+EX_PERMITS_ISSUED = """
     SELECT
         CONCAT(CONCAT(f.FOLDERYEAR, '-'), f.FOLDERSEQUENCE) AS PERMIT_ID,
         f.SUBCODE,
@@ -145,8 +188,95 @@ QUERIES = {
         FOLDERTYPE in('EX')
         AND ISSUEDATE >= TO_DATE('10-01-2018', 'mm-dd-yyyy')
         AND ISSUEDATE IS NOT NULL
+        AND PRIORITY = 3{partition}
+	"""
+
+QUERIES = {
+    "applications_received": count_query(DAILY_COUNT, "applications_received"),
+    "active_permits": """
+    SELECT
+        Foldertype,
+        COUNT(1) ACTIVEPERMITS
+    FROM
+        folder
+    WHERE (foldertype in('EX', 'DS')
+        AND STATUSCODE IN(50010))
+        OR(foldertype in('RW')
+            AND STATUSCODE IN(50010)
+            AND FOLDERNAME NOT LIKE 'LA-%')
+    GROUP BY
+        Foldertype
+    ORDER BY
+        Foldertype
+    """,
+    "issued_permits": count_query(DAILY_COUNT, "issued_permits"),
+    "applications_received_weekly": count_query(WEEKLY_COUNT, "applications_received"),
+    "issued_permits_weekly": count_query(WEEKLY_COUNT, "issued_permits"),
+    "review_time": REVIEW_TIME.format(partition=""),
+    "ex_permits_issued": EX_PERMITS_ISSUED.format(partition=""),
+}
+
+"""
+Incremental queries:
+
+Versions of the daily count queries that only return the days on or after the :start_date bind variable,
+see count_query. date_col is the name of the date column in the query results and the CSV stored in S3.
+
+"""
+
+INCREMENTAL_QUERIES = {
+    count: {
+        "date_col": f"TO_CHAR(ROUND({COUNTS[count][0]},'DDD'),'YYYY-MM-DD')",
+        "query": count_query(DAILY_COUNT, count, incremental=True),
+    }
+    for count in ["applications_received", "issued_permits"]
+}
+
+"""
+Partitioned queries:
+
+Versions of the largest queries that only return the rows between the :low and :high bind variables
+of a partition key, so slices of the results can be fetched in parallel. bounds returns the lowest value
+and one past the highest value of the key. Numeric keys are split into equal ranges, date keys
+are split into calendar years.
+
+"""
+
+PARTITIONED_QUERIES = {
+    "review_time": {
+        "key": "range",
+        "bounds": """
+    SELECT
+        MIN(FOLDERRSN),
+        MAX(FOLDERRSN) + 1
+    FROM
+        FOLDER
+    WHERE
+        FOLDERTYPE = 'RW'
+        AND SUBCODE = 50500
+        AND WORKCODE = 50590
+    """,
+        "query": REVIEW_TIME.format(
+            partition="\n        AND f.FOLDERRSN >= :low\n        AND f.FOLDERRSN < :high"
+        ),
+    },
+    "ex_permits_issued": {
+        "key": "year",
+        "bounds": """
+    SELECT
+        MIN(ISSUEDATE),
+        MAX(ISSUEDATE) + 1
+    FROM
+        FOLDER
+    WHERE
+        FOLDERTYPE in('EX')
+        AND ISSUEDATE >= TO_DATE('10-01-2018', 'mm-dd-yyyy')
         AND PRIORITY = 3
-	""",
+    """,
+        "query": EX_PERMITS_ISSUED.format(
+            partition="\n        AND ISSUEDATE >= :low\n        AND ISSUEDATE < :high"
+        ),
+    },
 }
 
 
@@ -169,6 +299,32 @@ def get_conn():
     return cx_Oracle.connect(user=USER, password=PASSWORD, dsn=dsn_tns)
 
 
+def get_pool(size):
+    """
+    Create a pool of connections to the AMANDA Read replica database that can be shared between threads
+
+    Parameters
+    ----------
+    size : Int maximum number of connections in the pool
+
+    Returns
+    -------
+    cx_Oracle SessionPool Object
+
+    """
+    dsn_tns = cx_Oracle.makedsn(HOST, PORT, service_name=SERVICE_NAME)
+    return cx_Oracle.SessionPool(
+        user=USER,
+        password=PASSWORD,
+        dsn=dsn_tns,
+        min=1,
+        max=size,
+        increment=1,
+        threaded=True,
+        getmode=cx_Oracle.SPOOL_ATTRVAL_WAIT,
+    )
+
+
 def row_factory(cursor):
     """
     Define cursor row handler which returns each row as a dict
@@ -186,9 +342,40 @@ def row_factory(cursor):
     return lambda *args: dict(zip([d[0] for d in cursor.description], args))
 
 
-def df_to_s3(df, resource, filename):
+def fetch_columns(cursor, batch_size):
+    """
+    Fetches all the rows of an executed query into a dataframe. Each batch of row tuples
+    is transposed into per-column lists, so no dict is built for each row.
+
+    Parameters
+    ----------
+    cursor : cx_Oracle Cursor object that has executed a query
+    batch_size : Int number of rows to fetch from the database at a time
+
+    Returns
+    -------
+    Pandas Dataframe of the query results
+
+    """
+    columns = [[] for _ in cursor.description]
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for column, values in zip(columns, zip(*rows)):
+            column.extend(values)
+
+    return pd.DataFrame(
+        {
+            d[0]: pd.Series(values, dtype=COLUMN_DTYPES.get(d[1]))
+            for d, values in zip(cursor.description, columns)
+        }
+    )
+
+
+def df_to_s3(df, resource, filename, output_format="csv"):
     """
-    Send pandas dataframe to an S3 bucket as a CSV
+    Send pandas dataframe to an S3 bucket as a CSV, gzipped CSV or Parquet file
     h/t https://stackoverflow.com/questions/38154040/save-dataframe-to-csv-directly-to-s3-python
 
     Parameters
@@ -196,45 +383,368 @@ def df_to_s3(df, resource, filename):
     df : Pandas Dataframe
     resource : boto3 s3 resource
     filename : String of the file that will be created in the S3 bucket ex:
+    output_format : String, one of s3_utils.OUTPUT_FORMATS
+
+    Returns
+    -------
+    bool: True if the file was uploaded, False if it was unchanged
 
     """
-    csv_buffer = StringIO()
-    df.to_csv(csv_buffer, index=False)
-    resource.Object(BUCKET, f"{filename}.csv").put(Body=csv_buffer.getvalue())
+    key = f"{filename}{s3_utils.OUTPUT_FORMATS[output_format]}"
+    body = s3_utils.serialize_df(df, output_format)
+    uploaded = s3_utils.put_if_changed(resource, BUCKET, key, body)
+    if not uploaded:
+        logger.info(f"{key} is unchanged, skipped upload")
+    return uploaded
 
 
-def main(args):
-    # Connect to AMANDA RR DB
-    conn = get_conn()
-    cursor = conn.cursor()
+def get_watermark(resource, query):
+    """
+    Returns the watermark of the last incremental run of a query, which holds the most recent date
+    already stored in S3 and when the query last ran in full
 
-    # Execute our query
-    logger.info(f"Executing query: {args.query}")
-    cursor.execute(QUERIES[args.query])
-    cursor.rowfactory = row_factory(cursor)
-    rows = cursor.fetchall()
-    conn.close()
+    Parameters
+    ----------
+    resource : boto3 s3 resource
+    query : String of the query name
 
-    # Upload to S3
-    logger.info(f"Uploading {len(rows)} rows to S3")
-    s3_resource = boto3.resource(
+    Returns
+    -------
+    dict of "watermark" and "full_refresh" datetimes, empty if no watermark has been stored yet
+
+    """
+    try:
+        response = resource.Object(BUCKET, f"watermarks/{query}.json").get()
+    except resource.meta.client.exceptions.NoSuchKey:
+        return {}
+    body = json.loads(response["Body"].read())
+    return {
+        "watermark": datetime.strptime(body["watermark"], "%Y-%m-%d"),
+        "full_refresh": datetime.fromisoformat(body["full_refresh"]),
+    }
+
+
+def set_watermark(resource, query, df, full_refresh):
+    """
+    Stores the most recent date in the query results as the watermark for the next incremental run
+
+    Parameters
+    ----------
+    resource : boto3 s3 resource
+    query : String of the query name
+    df : Pandas Dataframe of all the query results
+    full_refresh : datetime of when the query last ran in full
+
+    """
+    dates = df[INCREMENTAL_QUERIES[query]["date_col"]].dropna()
+    if dates.empty:
+        # A max of no dates would be stored as NaN, which the next run can't parse
+        logger.info(f"No dates in the {query} results, keeping the stored watermark")
+        return
+    watermark = dates.max()
+    logger.info(f"Setting watermark for {query} to {watermark}")
+    body = {
+        "watermark": watermark,
+        "full_refresh": full_refresh.isoformat(),
+        "updated_at": datetime.now().isoformat(),
+    }
+    resource.Object(BUCKET, f"watermarks/{query}.json").put(Body=json.dumps(body))
+
+
+def incremental_update(
+    cursor, resource, query, watermark, window_days, output_format="csv"
+):
+    """
+    Re-queries the trailing window of days before the watermark and merges those
+    daily counts into the CSV already stored in S3
+
+    Parameters
+    ----------
+    cursor : cx_Oracle Cursor object
+    resource : boto3 s3 resource
+    query : String of the query name
+    watermark : datetime of the most recent date stored in S3
+    window_days : Int number of days before the watermark to re-query
+    output_format : String, the format of the file stored in S3
+
+    Returns
+    -------
+    Pandas Dataframe of the merged data, or None if there is no file in S3 to merge into,
+        for example after changing the output format
+
+    """
+    date_col = INCREMENTAL_QUERIES[query]["date_col"]
+    start_date = watermark - timedelta(days=window_days)
+    key = f"{query}{s3_utils.OUTPUT_FORMATS[output_format]}"
+    try:
+        response = resource.Object(BUCKET, key).get()
+    except resource.meta.client.exceptions.NoSuchKey:
+        logger.info(f"{key} is not in S3 yet, nothing to merge the incremental results into")
+        return None
+    existing = s3_utils.read_df(response["Body"], key, dtype={date_col: str})
+
+    logger.info(f"Executing incremental query: {query} starting {start_date:%Y-%m-%d}")
+    cursor.execute(INCREMENTAL_QUERIES[query]["query"], start_date=start_date)
+    new = fetch_columns(cursor, cursor.arraysize)
+
+    # Replace the days we re-queried with the new counts
+    existing = existing[existing[date_col] < f"{start_date:%Y-%m-%d}"]
+    logger.info(f"Merging {len(new)} new rows with {len(existing)} existing rows")
+    df = pd.concat([existing, new], ignore_index=True)
+    df = df.sort_values(["FOLDERTYPE", date_col], kind="stable")
+
+    return df
+
+
+def stream_to_s3(cursor, resource, filename, batch_size, output_format="csv"):
+    """
+    Streams the results of an executed query to an S3 bucket as a CSV. Rows are fetched in batches
+    and spooled to a temporary file, so only one batch of the CSV is held in memory.
+    If the CSV is the same as the one already in S3 nothing is uploaded and the stored file is kept.
+
+    Parameters
+    ----------
+    cursor : cx_Oracle Cursor object that has executed a query
+    resource : boto3 s3 resource
+    filename : String of the file that will be created in the S3 bucket ex:
+    batch_size : Int number of rows to fetch from the database at a time
+    output_format : String, csv or csv.gz
+
+    Returns
+    -------
+    int: the number of rows fetched
+
+    """
+    key = f"{filename}{s3_utils.OUTPUT_FORMATS[output_format]}"
+    row_count = 0
+
+    def csv_chunks():
+        nonlocal row_count
+        csv_buffer = StringIO()
+        writer = csv.writer(csv_buffer, lineterminator="\n")
+        writer.writerow([d[0] for d in cursor.description])
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            writer.writerows(rows)
+            row_count += len(rows)
+            yield csv_buffer.getvalue().encode("utf-8")
+            csv_buffer.seek(0)
+            csv_buffer.truncate()
+        # Only the header is left in the buffer when the query returned no rows
+        yield csv_buffer.getvalue().encode("utf-8")
+
+    uploaded = s3_utils.upload_stream(
+        resource, BUCKET, key, s3_utils.compress_chunks(csv_chunks(), output_format)
+    )
+    if not uploaded:
+        logger.info(f"{key} is unchanged, skipped upload")
+    return row_count
+
+
+def get_partitions(cursor, query, partitions):
+    """
+    Splits the partition key of a query into slices
+
+    Parameters
+    ----------
+    cursor : cx_Oracle Cursor object
+    query : String of the query name
+    partitions : Int number of slices for numeric keys
+
+    Returns
+    -------
+    list of (low, high) tuples, the low value is inclusive and the high value is exclusive
+
+    """
+    cursor.execute(PARTITIONED_QUERIES[query]["bounds"])
+    low, high = cursor.fetchone()
+    if low is None:
+        return []
+
+    if PARTITIONED_QUERIES[query]["key"] == "year":
+        edges = [datetime(year, 1, 1) for year in range(low.year + 1, high.year + 1)]
+        edges = [low] + edges + [high]
+    else:
+        low, high = int(low), int(high)
+        step = max(-(-(high - low) // partitions), 1)
+        edges = list(range(low, high, step)) + [high]
+
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def fetch_partition(pool, query, low, high, batch_size):
+    """
+    Fetches one slice of a partitioned query on its own pooled connection
+
+    Returns
+    -------
+    Pandas Dataframe of the rows in this slice
+
+    """
+    conn = pool.acquire()
+    try:
+        cursor = conn.cursor()
+        cursor.arraysize = batch_size
+        cursor.execute(PARTITIONED_QUERIES[query]["query"], low=low, high=high)
+        df = fetch_columns(cursor, batch_size)
+    finally:
+        pool.release(conn)
+    logger.info(f"{query}: fetched {len(df)} rows from {low} to {high}")
+    return df
+
+
+def run_partitioned(pool, query, partitions, args, executor):
+    """
+    Fetches the slices of a partitioned query in parallel and concatenates them in order
+
+    Parameters
+    ----------
+    pool : cx_Oracle SessionPool object
+    query : String of the query name
+    partitions : list of (low, high) tuples from get_partitions
+    args : argparse Namespace of the CLI arguments
+    executor : ThreadPoolExecutor shared by the slices of every query
+
+    Returns
+    -------
+    Pandas Dataframe of all the rows
+
+    """
+    logger.info(f"Executing query: {query} in {len(partitions)} partitions")
+    results = executor.map(
+        lambda p: fetch_partition(pool, query, p[0], p[1], args.batch_size),
+        partitions,
+    )
+    dfs = list(results)
+    if not dfs:
+        return pd.DataFrame()
+    return pd.concat(dfs, ignore_index=True)
+
+
+def run_query(pool, query, args, partition_executor=None):
+    """
+    Runs one of the QUERIES on a pooled connection and sends the results to S3
+
+    Parameters
+    ----------
+    pool : cx_Oracle SessionPool object
+    query : String of the query name
+    args : argparse Namespace of the CLI arguments
+    partition_executor : ThreadPoolExecutor that fetches the slices of partitioned queries
+
+    Returns
+    -------
+    int: the number of rows uploaded
+
+    """
+    # Each thread gets its own session, creating resources from the shared default session is not thread safe
+    s3_resource = boto3.session.Session().resource(
         "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS
     )
-    df = pd.DataFrame(rows)
-    df_to_s3(df, s3_resource, args.query)
 
+    conn = pool.acquire()
+    try:
+        cursor = conn.cursor()
+        cursor.arraysize = args.batch_size
+
+        # Counts of old days change when a folder's status changes later on, so the
+        # whole query runs again every few days to pick those up
+        now = datetime.now()
+        if args.incremental and query in INCREMENTAL_QUERIES:
+            watermark = get_watermark(s3_resource, query)
+            full = not watermark or (
+                now - watermark["full_refresh"] > timedelta(days=args.full_every_days)
+            )
+            df = None
+            if not full:
+                df = incremental_update(
+                    cursor,
+                    s3_resource,
+                    query,
+                    watermark["watermark"],
+                    args.window_days,
+                    args.format,
+                )
+            if df is not None:
+                pool.release(conn)
+                conn = None
+                df_to_s3(df, s3_resource, query, args.format)
+                set_watermark(s3_resource, query, df, watermark["full_refresh"])
+                return len(df)
+            logger.info(f"Running the full query for {query} in incremental mode")
+
+        if args.partitioned and query in PARTITIONED_QUERIES:
+            partitions = get_partitions(cursor, query, args.partitions)
+            # Free this connection up for the partitions
+            pool.release(conn)
+            conn = None
+            df = run_partitioned(pool, query, partitions, args, partition_executor)
+        else:
+            # Execute our query
+            logger.info(f"Executing query: {query}")
+            cursor.execute(QUERIES[query])
+
+            if args.stream:
+                logger.info(
+                    f"Streaming {query} rows to S3 in batches of {args.batch_size}"
+                )
+                return stream_to_s3(
+                    cursor, s3_resource, query, args.batch_size, args.format
+                )
+
+            df = fetch_columns(cursor, args.batch_size)
+    finally:
+        if conn:
+            pool.release(conn)
 
-# CLI argument definition
-parser = argparse.ArgumentParser()
+    # Upload to S3
+    logger.info(f"Uploading {len(df)} {query} rows to S3")
+    df_to_s3(df, s3_resource, query, args.format)
+    if args.incremental and query in INCREMENTAL_QUERIES:
+        set_watermark(s3_resource, query, df, now)
+    return len(df)
 
-parser.add_argument(
-    "--query",
-    choices=list(QUERIES.keys()),
-    required=True,
-    help="Name of the query defined by the dict at the top of this script. Ex: applications_received",
-)
 
-args = parser.parse_args()
+def main(args):
+    if "all" in args.query:
+        queries = list(QUERIES.keys())
+    else:
+        queries = list(dict.fromkeys(args.query))
+
+    # Connect to AMANDA RR DB
+    pool = get_pool(args.workers)
+
+    # The slices of every partitioned query share one executor, so there are never more than
+    # twice as many threads as workers. A query waiting for its slices holds no connection.
+    partition_executor = None
+    if args.partitioned:
+        partition_executor = ThreadPoolExecutor(max_workers=args.workers)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(args.workers, len(queries))) as executor:
+        futures = {
+            executor.submit(run_query, pool, query, args, partition_executor): query
+            for query in queries
+        }
+        for future in as_completed(futures):
+            query = futures[future]
+            try:
+                results[query] = future.result()
+                logger.info(f"{query}: uploaded {results[query]} rows to S3")
+            except Exception as e:
+                results[query] = e
+                logger.error(f"{query}: failed with {e!r}")
+    if partition_executor:
+        partition_executor.shutdown()
+    pool.close()
+
+    failed = [q for q in queries if isinstance(results[q], Exception)]
+    logger.info(f"Finished {len(queries) - len(failed)} of {len(queries)} queries")
+    if failed:
+        raise RuntimeError(f"Queries failed: {', '.join(failed)}")
+
 
 logger = utils.get_logger(
     __name__,
@@ -242,4 +752,88 @@ logger = utils.get_logger(
 )
 
 if __name__ == "__main__":
+    # CLI argument definition
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--query",
+        choices=list(QUERIES.keys()) + ["all"],
+        nargs="+",
+        required=True,
+        help="Name(s) of the queries defined by the dict at the top of this script, or all. Ex: applications_received",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=3,
+        help="Number of database connections used at the same time, defaults to 3",
+    )
+
+    parser.add_argument(
+        "--partitioned",
+        action="store_true",
+        help=f"Fetches slices of large queries in parallel. "
+        f"Supported queries: {', '.join(PARTITIONED_QUERIES.keys())}",
+    )
+
+    parser.add_argument(
+        "--partitions",
+        type=int,
+        default=8,
+        help="Number of slices for queries partitioned by a numeric range, defaults to 8",
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Streams the query results to S3 in batches instead of loading them all into memory",
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=10000,
+        help="Number of rows fetched from the database at a time, defaults to 10000",
+    )
+
+    parser.add_argument(
+        "--format",
+        choices=list(s3_utils.OUTPUT_FORMATS.keys()),
+        default="csv",
+        help="File format of the output in S3, defaults to csv",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=f"Only re-queries the most recent days and merges them into the CSV in S3, the whole query "
+        f"still runs every --full-every-days. Other queries run in full. Supported queries: {', '.join(INCREMENTAL_QUERIES.keys())}",
+    )
+
+    parser.add_argument(
+        "--window-days",
+        type=int,
+        default=7,
+        help="Number of days before the stored watermark to re-query in incremental mode, defaults to 7",
+    )
+
+    parser.add_argument(
+        "--full-every-days",
+        type=int,
+        default=7,
+        help="Number of days between full runs of each query in incremental mode, defaults to 7",
+    )
+
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.incremental and args.stream:
+        parser.error("--incremental and --stream cannot be used together")
+    if args.partitioned and args.stream:
+        parser.error("--partitioned and --stream cannot be used together")
+    if args.stream and args.format == "parquet":
+        parser.error("--stream only supports the csv and csv.gz formats")
+
     main(args)
@@ -0,0 +1,233 @@
+"""
+Measures extraction throughput of each AMANDA query against the local SQLite replica.
+Reports rows/sec and peak RSS after each stage. The stages are execute, fetch and upload, or
+execute and stream with --stream. The upload goes through the same df_to_s3 and stream_to_s3 helpers
+as amanda_to_s3.py, to an S3 bucket if one is given and otherwise to a local directory.
+
+Ex: python benchmark_extract.py --folders 1000000 --query review_time ex_permits_issued --stream
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+import amanda_to_s3
+from amanda_to_s3 import QUERIES, df_to_s3, fetch_columns, stream_to_s3
+from local_replica import SQLITE_QUERIES, create_replica, get_conn
+
+# AWS Credentials
+AWS_ACCESS_ID = os.getenv("EXEC_DASH_ACCESS_ID")
+AWS_PASS = os.getenv("EXEC_DASH_PASS")
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process in MB"""
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class PrefetchedCursor:
+    """
+    Wraps a cursor whose first batch of rows was already fetched, and returns that batch first.
+    SQLite only runs a query when its first rows are fetched, so the execute stage includes that fetch.
+    """
+
+    def __init__(self, cursor, rows):
+        self.cursor = cursor
+        self.description = cursor.description
+        self.rows = rows
+
+    def fetchmany(self, size):
+        if self.rows:
+            rows, self.rows = self.rows, None
+            return rows
+        return self.cursor.fetchmany(size)
+
+
+class LocalObject:
+    """Stands in for a boto3 s3 Object stored in a LocalResource"""
+
+    def __init__(self, resource, key):
+        self.path = resource.path(key)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+
+    @property
+    def metadata(self):
+        with open(f"{self.path}.metadata.json") as f:
+            return json.load(f)
+
+    @property
+    def e_tag(self):
+        with open(self.path, "rb") as f:
+            return f'"{hashlib.md5(f.read()).hexdigest()}"'
+
+    def put(self, Body, Metadata=None):
+        with open(self.path, "wb") as f:
+            f.write(Body)
+        with open(f"{self.path}.metadata.json", "w") as f:
+            json.dump(Metadata or {}, f)
+
+
+class LocalResource:
+    """
+    Stands in for a boto3 s3 resource and writes objects to a local directory, with only the calls
+    the s3_utils upload helpers make
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        # upload_fileobj is called on resource.meta.client
+        self.meta = type("Meta", (), {"client": self})
+
+    def path(self, key):
+        path = os.path.join(self.directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def Object(self, bucket, key):
+        return LocalObject(self, key)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None):
+        path = self.path(Key)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(Fileobj, f)
+        with open(f"{path}.metadata.json", "w") as f:
+            json.dump((ExtraArgs or {}).get("Metadata", {}), f)
+
+
+def benchmark_query(conn, query, args, s3_resource):
+    """
+    Runs one query through each stage of the extraction and prints the timings
+
+    Parameters
+    ----------
+    conn : sqlite3 Connection object
+    query : String of the query name
+    args : argparse Namespace of the CLI arguments
+    s3_resource : boto3 s3 resource or LocalResource that the results are uploaded to
+
+    """
+    timings = []
+    filename = f"benchmark/{query}"
+
+    start = time.perf_counter()
+    cursor = conn.execute(SQLITE_QUERIES[query])
+    cursor = PrefetchedCursor(cursor, cursor.fetchmany(args.batch_size))
+    timings.append(("execute", time.perf_counter() - start, peak_rss()))
+
+    if args.stream:
+        start = time.perf_counter()
+        rows = stream_to_s3(cursor, s3_resource, filename, args.batch_size, args.format)
+        timings.append(("stream", time.perf_counter() - start, peak_rss()))
+    else:
+        start = time.perf_counter()
+        df = fetch_columns(cursor, args.batch_size)
+        rows = len(df)
+        timings.append(("fetch", time.perf_counter() - start, peak_rss()))
+
+        start = time.perf_counter()
+        df_to_s3(df, s3_resource, filename, args.format)
+        timings.append(("upload", time.perf_counter() - start, peak_rss()))
+
+    for stage, elapsed, rss in timings:
+        rate = rows / elapsed if elapsed else float("inf")
+        print(
+            f"{query:>28} {stage:>9}: {rows:>9} rows, {elapsed:8.3f} s, "
+            f"{rate:12,.0f} rows/s, peak RSS {rss:8.1f} MB"
+        )
+
+
+def main(args):
+    db_path = args.path
+    if not os.path.exists(db_path):
+        print(f"Creating local replica with {args.folders} folders at {db_path}")
+        create_replica(db_path, args.folders)
+
+    # Catch queries that were added to amanda_to_s3 without a SQLite version
+    missing = set(QUERIES) - set(SQLITE_QUERIES)
+    if missing:
+        raise KeyError(f"No SQLite version of the queries: {', '.join(missing)}")
+
+    # The upload helpers write to the bucket of amanda_to_s3
+    if args.bucket:
+        amanda_to_s3.BUCKET = args.bucket
+        s3_resource = boto3.resource(
+            "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS
+        )
+    else:
+        out_dir = tempfile.mkdtemp()
+        print(f"Writing uploads to {out_dir}")
+        s3_resource = LocalResource(out_dir)
+
+    conn = get_conn(db_path)
+    queries = args.query or list(QUERIES.keys())
+    for query in queries:
+        benchmark_query(conn, query, args, s3_resource)
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--path",
+        default="amanda.db",
+        help="Path of the SQLite replica, it is created if it does not exist. Defaults to amanda.db",
+    )
+
+    parser.add_argument(
+        "--folders",
+        type=int,
+        default=100000,
+        help="Number of FOLDER rows when creating the replica, defaults to 100000",
+    )
+
+    parser.add_argument(
+        "--query",
+        choices=list(QUERIES.keys()),
+        nargs="+",
+        help="Name(s) of the queries to benchmark, defaults to all of them",
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=10000,
+        help="Number of rows fetched at a time, defaults to 10000",
+    )
+
+    parser.add_argument(
+        "--bucket",
+        help="S3 bucket to upload to, defaults to writing to a temporary directory. "
+        "Files that are unchanged since the last run are not uploaded again",
+    )
+
+    parser.add_argument(
+        "--format",
+        choices=["csv", "csv.gz", "parquet"],
+        default="csv",
+        help="Format of the uploaded files, defaults to csv",
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Streams the rows to the upload in batches with stream_to_s3 instead of building a dataframe",
+    )
+
+    args = parser.parse_args()
+    if args.stream and args.format == "parquet":
+        parser.error("--stream only supports the csv and csv.gz formats")
+
+    main(args)
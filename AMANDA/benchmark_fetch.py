@@ -0,0 +1,118 @@
+"""
+Micro-benchmark of building a dataframe from query results with the dict-per-row rowfactory
+and with the columnar fetch_columns. Uses a fake cursor that returns rows shaped like review_time,
+so it can be run without a connection to the AMANDA read replica.
+
+Ex: python benchmark_fetch.py --rows 100000 1000000
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import time
+import tracemalloc
+
+import cx_Oracle
+import pandas as pd
+
+from amanda_to_s3 import fetch_columns, row_factory
+
+# Same columns as the review_time query
+DESCRIPTION = [
+    ("CUSTOMFOLDERNUMBER", cx_Oracle.DB_TYPE_VARCHAR),
+    ("FOLDERRSN", cx_Oracle.DB_TYPE_NUMBER),
+    ("INDATE", cx_Oracle.DB_TYPE_DATE),
+    ("ISSUEDATE", cx_Oracle.DB_TYPE_DATE),
+    ("WEBAPPSTART", cx_Oracle.DB_TYPE_DATE),
+    ("WEBAPPEND", cx_Oracle.DB_TYPE_DATE),
+    ("EXTEND", cx_Oracle.DB_TYPE_DATE),
+    ("DEPT_COMMENTS", cx_Oracle.DB_TYPE_DATE),
+]
+
+
+class FakeCursor:
+    """Stands in for a cx_Oracle cursor that has executed a query"""
+
+    def __init__(self, rows):
+        self.description = [d + (None, None, None, None, True) for d in DESCRIPTION]
+        self.rowfactory = None
+        self.rows = rows
+        self.position = 0
+
+    def fetchmany(self, size):
+        batch = self.rows[self.position : self.position + size]
+        self.position += size
+        if self.rowfactory:
+            return [self.rowfactory(*row) for row in batch]
+        return batch
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows))
+
+
+def build_rows(count):
+    start = datetime(2018, 10, 1)
+    rows = []
+    for i in range(count):
+        indate = start + timedelta(minutes=i)
+        issued = indate + timedelta(days=10) if i % 3 else None
+        rows.append(
+            (f"2023-{i:06d} RW", i, indate, issued, indate, issued, None, indate)
+        )
+    return rows
+
+
+def with_row_factory(rows, batch_size):
+    cursor = FakeCursor(rows)
+    cursor.rowfactory = row_factory(cursor)
+    return pd.DataFrame(cursor.fetchall())
+
+
+def with_fetch_columns(rows, batch_size):
+    return fetch_columns(FakeCursor(rows), batch_size)
+
+
+def measure(func, rows, batch_size):
+    tracemalloc.start()
+    start = time.perf_counter()
+    df = func(rows, batch_size)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return df, elapsed, peak
+
+
+def main(args):
+    for count in args.rows:
+        rows = build_rows(count)
+        for name, func in [
+            ("row_factory", with_row_factory),
+            ("fetch_columns", with_fetch_columns),
+        ]:
+            df, elapsed, peak = measure(func, rows, args.batch_size)
+            print(
+                f"{name:>14} {count:>9} rows: {elapsed:8.3f} s, "
+                f"{count / elapsed:12,.0f} rows/s, peak {peak / 1024 ** 2:8.1f} MB"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--rows",
+        type=int,
+        nargs="+",
+        default=[100000, 1000000],
+        help="Number of rows to benchmark, defaults to 100000 and 1000000",
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=10000,
+        help="Number of rows fetched at a time, defaults to 10000",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,336 @@
+"""
+Creates a local SQLite stand-in for the AMANDA read replica with synthetic data, so the
+extraction can be measured without the city network. SQLITE_QUERIES has a SQLite version
+of each query in amanda_to_s3.QUERIES that returns the same columns.
+
+Ex: python local_replica.py --path amanda.db --folders 100000
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import random
+import sqlite3
+
+TABLES = [
+    """
+    CREATE TABLE FOLDER (
+        FOLDERRSN INTEGER PRIMARY KEY,
+        FOLDERTYPE TEXT,
+        SUBCODE INTEGER,
+        WORKCODE INTEGER,
+        STATUSCODE INTEGER,
+        PRIORITY INTEGER,
+        FOLDERYEAR TEXT,
+        FOLDERSEQUENCE TEXT,
+        FOLDERNAME TEXT,
+        CUSTOMFOLDERNUMBER TEXT,
+        INDATE TIMESTAMP,
+        ISSUEDATE TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE FOLDERPROCESS (
+        PROCESSRSN INTEGER PRIMARY KEY,
+        FOLDERRSN INTEGER,
+        PROCESSCODE INTEGER,
+        STARTDATE TIMESTAMP,
+        ENDDATE TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE FOLDERPROCESSATTEMPT (
+        ATTEMPTRSN INTEGER PRIMARY KEY,
+        FOLDERRSN INTEGER,
+        RESULTCODE INTEGER,
+        ATTEMPTDATE TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE VALIDSUB (
+        SUBCODE INTEGER PRIMARY KEY,
+        SUBDESC TEXT
+    )
+    """,
+    "CREATE INDEX FOLDER_TYPE ON FOLDER (FOLDERTYPE)",
+    "CREATE INDEX FOLDERPROCESS_RSN ON FOLDERPROCESS (FOLDERRSN)",
+    "CREATE INDEX FOLDERPROCESSATTEMPT_RSN ON FOLDERPROCESSATTEMPT (FOLDERRSN)",
+]
+
+FOLDERTYPES = ["DS", "EX", "RW"]
+SUBCODES = [50500, 50505, 50510, 50515, 50520]
+WORKCODES = [50590, 50595]
+STATUSCODES = [50003, 50005, 50010, 50020, 70045]
+
+"""
+SQLite versions of the AMANDA queries. ROUND(x, 'DDD') becomes adding 12 hours before taking the date,
+and the Saturday ending each week is found with the 'weekday 6' modifier. Columns are aliased to the
+names Oracle gives them.
+"""
+
+SQLITE_QUERIES = {
+    "applications_received": """
+    SELECT
+        FOLDERTYPE AS FOLDERTYPE,
+        SUBCODE AS SUBCODE,
+        DATE(INDATE, '+12 hours') AS "TO_CHAR(ROUND(INDATE,'DDD'),'YYYY-MM-DD')",
+        COUNT(1) AS ISSUEDROWPERMITS
+    FROM
+        FOLDER
+    WHERE (FOLDERTYPE IN('DS')
+        AND STATUSCODE NOT IN(50005, 50003, 70045)
+        AND INDATE >= '2018-10-01'
+        AND INDATE IS NOT NULL)
+        OR(FOLDERTYPE IN('RW', 'EX')
+            AND STATUSCODE NOT IN(70045, 50003)
+            AND INDATE >= '2018-10-01'
+            AND SUBCODE NOT IN(50510, 50505)
+            AND INDATE IS NOT NULL)
+    GROUP BY
+        DATE(INDATE, '+12 hours'),
+        FOLDERTYPE,
+        SUBCODE
+    ORDER BY
+        FOLDERTYPE
+    """,
+    "active_permits": """
+    SELECT
+        FOLDERTYPE AS FOLDERTYPE,
+        COUNT(1) AS ACTIVEPERMITS
+    FROM
+        FOLDER
+    WHERE (FOLDERTYPE IN('EX', 'DS')
+        AND STATUSCODE IN(50010))
+        OR(FOLDERTYPE IN('RW')
+            AND STATUSCODE IN(50010)
+            AND FOLDERNAME NOT LIKE 'LA-%')
+    GROUP BY
+        FOLDERTYPE
+    ORDER BY
+        FOLDERTYPE
+    """,
+    "issued_permits": """
+    SELECT
+        FOLDERTYPE AS FOLDERTYPE,
+        SUBCODE AS SUBCODE,
+        DATE(ISSUEDATE, '+12 hours') AS "TO_CHAR(ROUND(ISSUEDATE,'DDD'),'YYYY-MM-DD')",
+        COUNT(1) AS ISSUEDROWPERMITS
+    FROM
+        FOLDER
+    WHERE (FOLDERTYPE IN('EX', 'DS')
+        AND ISSUEDATE >= '2018-10-01'
+        AND ISSUEDATE IS NOT NULL)
+        OR(FOLDERTYPE IN('RW')
+            AND ISSUEDATE >= '2018-10-01'
+            AND SUBCODE NOT IN(50510, 50505)
+            AND ISSUEDATE IS NOT NULL)
+    GROUP BY
+        DATE(ISSUEDATE, '+12 hours'),
+        FOLDERTYPE,
+        SUBCODE
+    ORDER BY
+        FOLDERTYPE
+    """,
+    "applications_received_weekly": """
+    SELECT
+        FOLDERTYPE AS FOLDERTYPE,
+        DATE(INDATE, '+12 hours', 'start of day', 'weekday 6') AS WEEK,
+        COUNT(1) AS ISSUEDROWPERMITS
+    FROM
+        FOLDER
+    WHERE (FOLDERTYPE IN('DS')
+        AND STATUSCODE NOT IN(50005, 50003, 70045)
+        AND INDATE >= '2018-10-01'
+        AND INDATE IS NOT NULL)
+        OR(FOLDERTYPE IN('RW', 'EX')
+            AND STATUSCODE NOT IN(70045, 50003)
+            AND INDATE >= '2018-10-01'
+            AND SUBCODE NOT IN(50510, 50505)
+            AND INDATE IS NOT NULL)
+    GROUP BY
+        DATE(INDATE, '+12 hours', 'start of day', 'weekday 6'),
+        FOLDERTYPE
+    ORDER BY
+        FOLDERTYPE
+    """,
+    "issued_permits_weekly": """
+    SELECT
+        FOLDERTYPE AS FOLDERTYPE,
+        DATE(ISSUEDATE, '+12 hours', 'start of day', 'weekday 6') AS WEEK,
+        COUNT(1) AS ISSUEDROWPERMITS
+    FROM
+        FOLDER
+    WHERE (FOLDERTYPE IN('EX', 'DS')
+        AND ISSUEDATE >= '2018-10-01'
+        AND ISSUEDATE IS NOT NULL)
+        OR(FOLDERTYPE IN('RW')
+            AND ISSUEDATE >= '2018-10-01'
+            AND SUBCODE NOT IN(50510, 50505)
+            AND ISSUEDATE IS NOT NULL)
+    GROUP BY
+        DATE(ISSUEDATE, '+12 hours', 'start of day', 'weekday 6'),
+        FOLDERTYPE
+    ORDER BY
+        FOLDERTYPE
+    """,
+    "review_time": """
+    SELECT
+        f.CUSTOMFOLDERNUMBER AS CUSTOMFOLDERNUMBER,
+        f.FOLDERRSN AS FOLDERRSN,
+        f.INDATE AS INDATE,
+        f.ISSUEDATE AS ISSUEDATE,
+        pa.STARTDATE AS WEBAPPSTART,
+        pa.ENDDATE AS WEBAPPEND,
+        pe.STARTDATE AS EXTEND,
+        fa.ATTEMPTDATE AS DEPT_COMMENTS
+    FROM
+        FOLDER f
+        LEFT OUTER JOIN FOLDERPROCESS pa ON f.FOLDERRSN = pa.FOLDERRSN
+        AND pa.PROCESSCODE = 70000
+        LEFT OUTER JOIN FOLDERPROCESS pe ON f.FOLDERRSN = pe.FOLDERRSN
+        AND pe.PROCESSCODE = 50680
+        LEFT OUTER JOIN FOLDERPROCESSATTEMPT fa ON f.FOLDERRSN = fa.FOLDERRSN
+    WHERE
+        f.FOLDERTYPE = 'RW'
+        AND f.SUBCODE = 50500
+        AND f.WORKCODE = 50590
+        AND fa.RESULTCODE = 61510
+    """,
+    "ex_permits_issued": """
+    SELECT
+        f.FOLDERYEAR || '-' || f.FOLDERSEQUENCE AS PERMIT_ID,
+        f.SUBCODE AS SUBCODE,
+        vs.SUBDESC AS SUBDESC,
+        f.FOLDERNAME AS FOLDERNAME,
+        STRFTIME('%m-%d-%Y %H:%M:%S', f.INDATE) AS "TO_CHAR(F.INDATE,'MM-DD-YYYYHH24:MI:SS')",
+        STRFTIME('%m-%d-%Y %H:%M:%S', f.ISSUEDATE) AS "TO_CHAR(F.ISSUEDATE,'MM-DD-YYYYHH24:MI:SS')"
+    FROM
+        FOLDER f
+        LEFT OUTER JOIN VALIDSUB vs ON f.SUBCODE = vs.SUBCODE
+    WHERE
+        FOLDERTYPE IN('EX')
+        AND ISSUEDATE >= '2018-10-01'
+        AND ISSUEDATE IS NOT NULL
+        AND PRIORITY = 3
+    """,
+}
+
+
+def get_conn(path):
+    """
+    Connect to the local SQLite replica
+
+    Parameters
+    ----------
+    path : String of the path to the SQLite database file
+
+    Returns
+    -------
+    sqlite3 Connection Object
+
+    """
+    return sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+
+
+def folder_rows(folders, rng):
+    """Yields synthetic FOLDER rows with dates spread from 2018 to today"""
+    start = datetime(2018, 1, 1)
+    span = int((datetime.now() - start).total_seconds())
+    for rsn in range(1, folders + 1):
+        indate = start + timedelta(seconds=rng.randrange(span))
+        issuedate = None
+        if rng.random() < 0.7:
+            issuedate = indate + timedelta(days=rng.randrange(1, 60))
+        foldername = f"LA-{rsn}" if rng.random() < 0.05 else f"{rng.randrange(100, 9999)} MAIN ST"
+        yield (
+            rsn,
+            rng.choice(FOLDERTYPES),
+            rng.choice(SUBCODES),
+            rng.choice(WORKCODES),
+            rng.choice(STATUSCODES),
+            rng.randrange(1, 5),
+            str(indate.year),
+            f"{rsn:06d}",
+            foldername,
+            f"{indate.year}-{rsn:06d} RW",
+            indate,
+            issuedate,
+        )
+
+
+def process_rows(folders, rng):
+    """Yields synthetic FOLDERPROCESS rows, about two per folder"""
+    for rsn in range(1, folders + 1):
+        for code in (70000, 50680):
+            if rng.random() < 0.8:
+                startdate = datetime(2018, 1, 1) + timedelta(minutes=rsn * 7)
+                yield (None, rsn, code, startdate, startdate + timedelta(days=3))
+
+
+def attempt_rows(folders, rng):
+    """Yields synthetic FOLDERPROCESSATTEMPT rows, about one per folder"""
+    for rsn in range(1, folders + 1):
+        if rng.random() < 0.9:
+            attemptdate = datetime(2018, 1, 1) + timedelta(minutes=rsn * 7, days=5)
+            yield (None, rsn, rng.choice([61510, 61520]), attemptdate)
+
+
+def create_replica(path, folders, seed=0):
+    """
+    Creates the AMANDA tables in a SQLite database and fills them with synthetic data
+
+    Parameters
+    ----------
+    path : String of the path to the SQLite database file, it is replaced if it exists
+    folders : Int number of FOLDER rows to create
+    seed : Int seed for the random data so runs are repeatable
+
+    """
+    rng = random.Random(seed)
+    conn = get_conn(path)
+    for table in ["FOLDER", "FOLDERPROCESS", "FOLDERPROCESSATTEMPT", "VALIDSUB"]:
+        conn.execute(f"DROP TABLE IF EXISTS {table}")
+    for statement in TABLES:
+        conn.execute(statement)
+
+    conn.executemany(
+        "INSERT INTO VALIDSUB VALUES (?, ?)",
+        [(code, f"Subcode {code}") for code in SUBCODES],
+    )
+    conn.executemany(
+        "INSERT INTO FOLDER VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        folder_rows(folders, rng),
+    )
+    conn.executemany(
+        "INSERT INTO FOLDERPROCESS VALUES (?, ?, ?, ?, ?)", process_rows(folders, rng)
+    )
+    conn.executemany(
+        "INSERT INTO FOLDERPROCESSATTEMPT VALUES (?, ?, ?, ?)",
+        attempt_rows(folders, rng),
+    )
+    conn.commit()
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--path",
+        default="amanda.db",
+        help="Path of the SQLite database file to create, defaults to amanda.db",
+    )
+
+    parser.add_argument(
+        "--folders",
+        type=int,
+        default=100000,
+        help="Number of FOLDER rows to create, defaults to 100000",
+    )
+
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed for the random data, defaults to 0",
+    )
+
+    args = parser.parse_args()
+
+    create_replica(args.path, args.folders, args.seed)
@@ -8,8 +8,13 @@ from sodapy import Socrata
 import pandas as pd
 import pytz
 
+import logging
 import os
 
+from common import s3_utils
+from common import socrata_utils
+import utils
+
 tz = "US/Central"
 
 # AWS Credentials
@@ -32,16 +37,17 @@ def s3_to_df(s3, filename):
     Parameters
     ----------
     s3 : boto3 S3 client object
-    filename (str): name of the file to access in the S3 bucket
+    filename (str): name of the CSV file to access in the S3 bucket, other formats are found with s3_utils.find_key
 
     Returns
     ----------
     (dataframe) : dataframe of the csv file stored in S3
     (str) : string of the date/time the file was last modified
     """
-    response = s3.get_object(Bucket=BUCKET, Key=filename)
+    key = s3_utils.find_key(s3, BUCKET, filename)
+    response = s3.get_object(Bucket=BUCKET, Key=key)
     return (
-        pd.read_csv(response.get("Body")),
+        s3_utils.read_df(response.get("Body"), key),
         response["LastModified"].astimezone(pytz.timezone(tz)).strftime("%Y-%m-%dT%H:%M:00.000"),
     )
 
@@ -69,7 +75,7 @@ def df_to_socrata(soda, df):
 
     """
     payload = df.to_dict("records")
-    soda.upsert(DATASET, payload)
+    socrata_utils.upsert_in_batches(soda, DATASET, payload, logger)
 
 def main():
     s3_client = boto3.client(
@@ -87,4 +93,5 @@ def main():
     df_to_socrata(soda, df)
 
 if __name__ == "__main__":
+    logger = utils.get_logger(__name__, level=logging.INFO)
     main()
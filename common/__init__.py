@@ -0,0 +1,4 @@
+"""
+Helpers shared by the scripts in this repo. The scripts import them as the common package,
+so the root of the repo needs to be on the PYTHONPATH, see the Dockerfile.
+"""
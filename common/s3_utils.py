@@ -0,0 +1,270 @@
+import gzip
+import hashlib
+from io import BytesIO
+import tempfile
+import zlib
+
+# File extension of each output format
+OUTPUT_FORMATS = {
+    "csv": ".csv",
+    "csv.gz": ".csv.gz",
+    "parquet": ".parquet",
+}
+
+# File extensions of the output formats, in order of preference when more than one version of a file exists
+EXTENSIONS = [".parquet", ".csv.gz", ".csv"]
+
+# dtypes that read_df reads as text
+TEXT_DTYPES = (str, "str", "string")
+
+
+def find_key(s3, bucket, filename):
+    """
+    Returns the key of the most recently modified version of a file in any of the output formats.
+    Falls back to the filename if no other version is found.
+
+    Parameters
+    ----------
+    s3 : boto3 S3 client object
+    bucket : String of the S3 bucket name
+    filename : String of the name of the CSV file in the S3 bucket
+
+    Returns
+    -------
+    String of the key of the file in the S3 bucket
+
+    """
+    stem = filename[: -len(".csv")] if filename.endswith(".csv") else filename
+    candidates = [stem + ext for ext in EXTENSIONS]
+    response = s3.list_objects_v2(Bucket=bucket, Prefix=stem)
+    objects = [o for o in response.get("Contents", []) if o["Key"] in candidates]
+    if not objects:
+        return filename
+    latest = max(objects, key=lambda o: (o["LastModified"], -candidates.index(o["Key"])))
+    return latest["Key"]
+
+
+def serialize_df(df, output_format, index=False, dtypes=None):
+    """
+    Serializes a dataframe in one of the OUTPUT_FORMATS
+
+    Parameters
+    ----------
+    df : Pandas Dataframe
+    output_format : String, one of csv, csv.gz or parquet
+    index : bool, whether to write the dataframe index
+    dtypes : dict of column name: pandas dtype that Parquet files store the column as,
+        the types of other columns are inferred by pyarrow. CSV files are written as is.
+
+    Returns
+    -------
+    bytes: the serialized file contents
+
+    """
+    if output_format == "parquet":
+        if index:
+            df = df.reset_index()
+        if dtypes:
+            df = df.astype({col: dtype for col, dtype in dtypes.items() if col in df.columns})
+        buffer = BytesIO()
+        df.to_parquet(buffer, index=False)
+        return buffer.getvalue()
+
+    body = df.to_csv(index=index).encode("utf-8")
+    if output_format == "csv.gz":
+        # A fixed mtime keeps the output the same for the same data, see put_if_changed
+        return gzip.compress(body, mtime=0)
+    return body
+
+
+def read_df(body, key, dtype=None, **kwargs):
+    """
+    Reads a file stored in one of the OUTPUT_FORMATS into a dataframe, based on the extension of its key
+
+    Parameters
+    ----------
+    body : file-like object such as the Body of a boto3 get_object response
+    key : String of the object key in the S3 bucket
+    dtype : dict of column name: dtype, or one dtype for every column, applied to both CSV and Parquet files.
+        Parquet files store whole numbers with missing values as floats, those are read as text
+        without the trailing .0 so they match the CSV.
+    kwargs : passed on to pandas read_csv for CSV files
+
+    Returns
+    -------
+    Pandas Dataframe, or an iterator of Pandas Dataframes if a chunksize is passed for a CSV file
+
+    """
+    import pandas as pd
+
+    if key.endswith(OUTPUT_FORMATS["csv.gz"]):
+        return pd.read_csv(body, compression="gzip", dtype=dtype, **kwargs)
+    if not key.endswith(OUTPUT_FORMATS["parquet"]):
+        return pd.read_csv(body, dtype=dtype, **kwargs)
+
+    df = pd.read_parquet(BytesIO(body.read()))
+    if dtype is None:
+        return df
+    dtypes = dtype if isinstance(dtype, dict) else dict.fromkeys(df.columns, dtype)
+    for col, col_dtype in dtypes.items():
+        if col not in df.columns:
+            continue
+        values = df[col]
+        if col_dtype not in TEXT_DTYPES:
+            df[col] = values.astype(col_dtype)
+            continue
+        if pd.api.types.is_float_dtype(values) and (values.dropna() % 1 == 0).all():
+            values = values.astype("Int64")
+        df[col] = values.astype("string")
+    return df
+
+
+def put_if_changed(resource, bucket, key, body):
+    """
+    Uploads the body to S3 unless the object already stored at the key has the same content.
+    A SHA-256 checksum of the body is stored in the object metadata to compare against on the next upload.
+    Objects uploaded before checksums were stored are compared by their ETag, which is the MD5 of a single part upload.
+
+    Parameters
+    ----------
+    resource : boto3 s3 resource
+    bucket : String of the S3 bucket name
+    key : String of the object key in the S3 bucket
+    body : String or bytes of the file contents
+
+    Returns
+    -------
+    bool: True if the object was uploaded, False if it was unchanged and the upload was skipped
+
+    """
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    checksum = hashlib.sha256(body).hexdigest()
+
+    if stored_checksum_matches(resource.Object(bucket, key), checksum, body):
+        return False
+
+    resource.Object(bucket, key).put(Body=body, Metadata={"sha256": checksum})
+    return True
+
+
+def stored_checksum_matches(obj, checksum, body=None):
+    """
+    Returns True if the S3 object exists and its stored checksum matches the given SHA-256 checksum
+
+    Parameters
+    ----------
+    obj : boto3 s3 Object
+    checksum : String of the SHA-256 hex digest of the new content
+    body : bytes of the new content, used to compare against the ETag of objects without a stored checksum
+
+    """
+    from botocore.exceptions import ClientError
+
+    try:
+        obj.load()
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return False
+        raise e
+
+    if "sha256" in obj.metadata:
+        return obj.metadata["sha256"] == checksum
+    if body is not None:
+        return obj.e_tag.strip('"') == hashlib.md5(body).hexdigest()
+    return False
+
+
+def compress_chunks(chunks, output_format):
+    """
+    Gzips chunks of bytes as they are produced for the csv.gz format, the chunks of other formats are passed on as is
+
+    Parameters
+    ----------
+    chunks : iterable of bytes
+    output_format : String, csv or csv.gz
+
+    Returns
+    -------
+    generator of bytes
+
+    """
+    if output_format != "csv.gz":
+        yield from chunks
+        return
+
+    # wbits=31 writes a gzip header, which has no timestamp so the output is the same for the same data
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        yield compressor.compress(chunk)
+    yield compressor.flush()
+
+
+def spool(chunks):
+    """
+    Writes chunks of bytes to a temporary file on disk and hashes them on the way, so a file can be
+    built without holding it in memory and its checksum is known before anything is uploaded
+
+    Parameters
+    ----------
+    chunks : iterable of bytes
+
+    Returns
+    -------
+    (temporary file object positioned at its start, String of the SHA-256 hex digest of its contents)
+
+    """
+    checksum = hashlib.sha256()
+    file = tempfile.TemporaryFile()
+    try:
+        for chunk in chunks:
+            checksum.update(chunk)
+            file.write(chunk)
+    except Exception as e:
+        file.close()
+        raise e
+    file.seek(0)
+    return file, checksum.hexdigest()
+
+
+def upload_spooled(resource, bucket, key, file, checksum):
+    """
+    Uploads a file from spool to S3 unless the object already stored at the key has the same checksum.
+    boto3 sends large files as a multipart upload, and the checksum is set in the metadata when
+    the upload is created, so no copy is needed afterwards to add it.
+
+    Parameters
+    ----------
+    resource : boto3 s3 resource
+    bucket : String of the S3 bucket name
+    key : String of the object key in the S3 bucket
+    file : file object positioned at its start
+    checksum : String of the SHA-256 hex digest of the file contents
+
+    Returns
+    -------
+    bool: True if the object was uploaded, False if it was unchanged and the upload was skipped
+
+    """
+    if stored_checksum_matches(resource.Object(bucket, key), checksum):
+        return False
+
+    resource.meta.client.upload_fileobj(
+        file, bucket, key, ExtraArgs={"Metadata": {"sha256": checksum}}
+    )
+    return True
+
+
+def upload_stream(resource, bucket, key, chunks):
+    """
+    Uploads chunks of bytes to S3 as one file unless the object already stored at the key has the same content,
+    see spool and upload_spooled
+
+    Returns
+    -------
+    bool: True if the object was uploaded, False if it was unchanged and the upload was skipped
+
+    """
+    file, checksum = spool(chunks)
+    with file:
+        return upload_spooled(resource, bucket, key, file, checksum)
@@ -0,0 +1,474 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from io import BytesIO
+import json
+import os
+import random
+import threading
+import time
+
+# Socrata responses that are worth retrying
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+# Starting size and limits for the adaptive batch size of upsert_in_batches
+BATCH_SIZE = 5000
+MIN_BATCH_SIZE = 500
+MAX_BATCH_SIZE = 50000
+
+
+def payload_hash(payload):
+    """
+    Returns a SHA-256 hex digest of the payload, used to tell whether a checkpoint belongs to the same data
+
+    Parameters
+    ----------
+    payload : list of dicts to upsert
+
+    Returns
+    -------
+    String
+
+    """
+    digest = hashlib.sha256()
+    for row in payload:
+        digest.update(json.dumps(row, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def checkpoint_location(checkpoint_path, dataset, run_id, digest):
+    """
+    Returns where the checkpoint of a load is stored, as a local path or (bucket, key) for an s3:// path
+
+    Parameters
+    ----------
+    checkpoint_path : String of a local directory or an s3://bucket/prefix
+    dataset : String of the Socrata dataset ID
+    run_id : String that identifies the run
+    digest : String hash of the payload
+
+    Returns
+    -------
+    String or tuple of (bucket, key)
+
+    """
+    name = f"{dataset}/{run_id}/{digest}.json"
+    if checkpoint_path.startswith("s3://"):
+        bucket, _, prefix = checkpoint_path[len("s3://"):].partition("/")
+        return bucket, f"{prefix.rstrip('/')}/{name}".lstrip("/")
+    return os.path.join(checkpoint_path, name)
+
+
+def read_checkpoint(location, s3_client=None):
+    """
+    Reads the checkpoint of a load, returns None if there is no checkpoint yet
+    """
+    if isinstance(location, tuple):
+        import boto3
+
+        s3_client = s3_client or boto3.client("s3")
+        try:
+            response = s3_client.get_object(Bucket=location[0], Key=location[1])
+        except s3_client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response["Body"].read())
+
+    if not os.path.exists(location):
+        return None
+    with open(location) as f:
+        return json.load(f)
+
+
+def write_checkpoint(location, checkpoint, s3_client=None):
+    """
+    Writes the checkpoint of a load, replacing the previous one
+    """
+    body = json.dumps(checkpoint)
+    if isinstance(location, tuple):
+        import boto3
+
+        s3_client = s3_client or boto3.client("s3")
+        s3_client.put_object(Bucket=location[0], Key=location[1], Body=body)
+        return
+
+    os.makedirs(os.path.dirname(location), exist_ok=True)
+    # Write to a temporary file first so a crash never leaves half of a checkpoint behind
+    with open(f"{location}.tmp", "w") as f:
+        f.write(body)
+    os.replace(f"{location}.tmp", location)
+
+
+def delete_checkpoint(location, s3_client=None):
+    """
+    Deletes the checkpoint of a load once every batch is acknowledged, along with its local run
+    and dataset directories if they are left empty
+    """
+    if isinstance(location, tuple):
+        import boto3
+
+        s3_client = s3_client or boto3.client("s3")
+        s3_client.delete_object(Bucket=location[0], Key=location[1])
+        return
+
+    if os.path.exists(location):
+        os.remove(location)
+    run_dir = os.path.dirname(location)
+    for directory in (run_dir, os.path.dirname(run_dir)):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            break
+
+
+def merge_ranges(ranges):
+    """
+    Merges overlapping and adjacent [start, end) row ranges, returns them sorted
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def dedupe_rows(payload, id_field):
+    """
+    Returns the payload with only the last row of each ID, in the order those rows appear in the payload
+
+    Parameters
+    ----------
+    payload : list of dicts to upsert
+    id_field : String of the field that uniquely identifies a row
+
+    Returns
+    -------
+    list of dicts
+
+    """
+    last = {}
+    for i, row in enumerate(payload):
+        last[row[id_field]] = i
+    if len(last) == len(payload):
+        return payload
+    return [payload[i] for i in sorted(last.values())]
+
+
+def send_batch(soda, dataset, rows, max_retries, logger):
+    """
+    Upserts one batch of rows to Socrata, retrying rate limits, server errors and timeouts
+    with exponential backoff
+
+    Parameters
+    ----------
+    soda : sodapy client object
+    dataset : String of the Socrata dataset ID
+    rows : list of dicts to upsert
+    max_retries : Int number of times to retry the batch before giving up
+    logger : logging.Logger
+
+    Returns
+    -------
+    (dict of the Socrata response, Int number of attempts, bool if Socrata asked us to slow down)
+
+    """
+    import requests
+
+    throttled = False
+    for attempt in range(max_retries + 1):
+        try:
+            return soda.upsert(dataset, rows), attempt + 1, throttled
+        except requests.exceptions.RequestException as e:
+            response = getattr(e, "response", None)
+            status = response.status_code if response is not None else None
+            retryable = status in RETRY_STATUS_CODES or isinstance(
+                e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+            )
+            if not retryable or attempt == max_retries:
+                raise e
+            throttled = True
+
+            wait = min(2 ** attempt, 60) + random.uniform(0, 1)
+            if response is not None and response.headers.get("Retry-After", "").isdigit():
+                wait = int(response.headers["Retry-After"])
+            logger.info(
+                f"Batch of {len(rows)} rows failed with {status or e!r}, retrying in {wait:.1f} s"
+            )
+            time.sleep(wait)
+
+
+def upsert_in_batches(
+    soda,
+    dataset,
+    payload,
+    logger,
+    batch_size=BATCH_SIZE,
+    workers=2,
+    max_retries=5,
+    target_seconds=30,
+    checkpoint_path=None,
+    run_id=None,
+    s3_client=None,
+    id_field=None,
+):
+    """
+    Upserts the payload to Socrata in batches, sending up to `workers` batches at a time. Failed batches
+    are retried with backoff, so one failure does not resend the whole payload. The batch size adapts as
+    the load runs: it is halved when a batch is throttled or slower than target_seconds, and grows by half
+    when batches finish in less than half of target_seconds.
+
+    Batches sent at the same time can finish in any order, so a row ID that appears in two of them
+    would not reliably end up with its last value. When id_field is given only the last row of each ID
+    is sent, otherwise the batches are sent one at a time.
+
+    Parameters
+    ----------
+    soda : sodapy client object
+    dataset : String of the Socrata dataset ID
+    payload : list of dicts to upsert
+    logger : logging.Logger
+    batch_size : Int number of rows in the first batches. A load split over several calls passes the
+        batch_size of the previous result, so the size keeps adapting instead of starting over
+    workers : Int number of batches sent at the same time
+    max_retries : Int number of times to retry each batch
+    target_seconds : Int seconds a batch should take
+    checkpoint_path : String of a local directory or s3://bucket/prefix to record acknowledged batches in
+        until the whole payload is upserted, or None to not keep checkpoints
+    run_id : String that identifies the run, a rerun with the same run_id and payload resumes from the
+        first batch that was not acknowledged
+    s3_client : boto3 s3 client object used for s3:// checkpoint paths
+    id_field : String of the field that uniquely identifies a row in the dataset, or None
+
+    Returns
+    -------
+    dict: the Socrata response counts summed over all batches, along with the rows,
+        seconds, rows_per_second, the stats of each batch and the batch_size for the next call
+
+    """
+    if id_field:
+        rows = dedupe_rows(payload, id_field)
+        if len(rows) < len(payload):
+            logger.info(
+                f"Dropped {len(payload) - len(rows)} rows whose {id_field} appears again later in the payload"
+            )
+        payload = rows
+    else:
+        workers = 1
+
+    state = {"offset": 0, "size": batch_size}
+    lock = threading.Lock()
+
+    location = None
+    done = []
+    if checkpoint_path:
+        checkpoint = {
+            "dataset": dataset,
+            "run_id": run_id,
+            "payload_hash": payload_hash(payload),
+            "rows": len(payload),
+            "acknowledged": [],
+        }
+        location = checkpoint_location(
+            checkpoint_path, dataset, run_id, checkpoint["payload_hash"]
+        )
+        checkpoint = read_checkpoint(location, s3_client) or checkpoint
+        done = merge_ranges(checkpoint["acknowledged"])
+        done_rows = sum(end - start for start, end in done)
+        if done_rows:
+            logger.info(
+                f"Resuming {dataset} run {run_id}: {done_rows} of {len(payload)} rows were already acknowledged"
+            )
+
+    def next_batch():
+        with lock:
+            start = state["offset"]
+            # Skip the rows a previous attempt of this run already upserted
+            for done_start, done_end in done:
+                if done_start <= start < done_end:
+                    start = done_end
+            if start >= len(payload):
+                return None
+            end = min(start + state["size"], len(payload))
+            for done_start, done_end in done:
+                if start < done_start < end:
+                    end = done_start
+                    break
+            state["offset"] = end
+            return start, end
+
+    def acknowledge(start, end):
+        if not location:
+            return
+        with lock:
+            checkpoint["acknowledged"] = merge_ranges(
+                checkpoint["acknowledged"] + [[start, end]]
+            )
+            write_checkpoint(location, checkpoint, s3_client)
+
+    def resize(factor):
+        with lock:
+            size = int(state["size"] * factor)
+            state["size"] = min(max(size, MIN_BATCH_SIZE), MAX_BATCH_SIZE)
+
+    def run_batches():
+        batch_stats = []
+        bounds = next_batch()
+        while bounds:
+            start, end = bounds
+            batch_start = time.perf_counter()
+            res, attempts, throttled = send_batch(
+                soda, dataset, payload[start:end], max_retries, logger
+            )
+            seconds = time.perf_counter() - batch_start
+            acknowledge(start, end)
+
+            if throttled or seconds > target_seconds:
+                resize(0.5)
+            elif seconds < target_seconds / 2:
+                resize(1.5)
+
+            batch_stats.append(
+                {
+                    "start": start,
+                    "rows": end - start,
+                    "seconds": round(seconds, 3),
+                    "attempts": attempts,
+                    "response": res,
+                }
+            )
+            logger.debug(
+                f"Batch of rows {start}-{end}: {seconds:.1f} s, {attempts} attempt(s), {res}"
+            )
+            bounds = next_batch()
+        return batch_stats
+
+    load_start = time.perf_counter()
+    batches = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_batches) for _ in range(workers)]
+        for future in futures:
+            batches.extend(future.result())
+    seconds = time.perf_counter() - load_start
+
+    # Every batch is acknowledged, so there is nothing left to resume
+    if location:
+        delete_checkpoint(location, s3_client)
+
+    batches.sort(key=lambda b: b["start"])
+    result = {}
+    for batch in batches:
+        for key, value in batch["response"].items():
+            if isinstance(value, int):
+                result[key] = result.get(key, 0) + value
+    result["rows"] = sum(batch["rows"] for batch in batches)
+    result["seconds"] = round(seconds, 3)
+    result["rows_per_second"] = round(result["rows"] / seconds, 1) if seconds else None
+    result["batches"] = batches
+    result["batch_size"] = state["size"]
+
+    logger.info(
+        f"Upserted {result['rows']} rows to {dataset} in {len(batches)} batches, "
+        f"{seconds:.1f} s, {result['rows_per_second']} rows/s"
+    )
+    return result
+
+
+def normalize_number(value):
+    """
+    Returns whole floats as ints and NaN as None, leaves other values as they are
+    """
+    if isinstance(value, float):
+        if value != value:
+            return None
+        if value.is_integer():
+            return int(value)
+    return value
+
+
+def row_digest(row):
+    """
+    Returns a signed 64-bit hash of the content of a row, used to tell whether the row changed since the last run.
+    Numbers are normalized first: pandas infers the dtypes of each chunk of a CSV on its own, so the same
+    integer is a float in a chunk where its column has a missing value.
+    """
+    row = {key: normalize_number(value) for key, value in row.items()}
+    content = json.dumps(row, sort_keys=True, default=str).encode()
+    return int.from_bytes(hashlib.blake2b(content, digest_size=8).digest(), "big", signed=True)
+
+
+def read_snapshot(s3_client, bucket, key):
+    """
+    Reads the row digest snapshot of a dataset from S3
+
+    Parameters
+    ----------
+    s3_client : boto3 s3 client object
+    bucket : String of the S3 bucket
+    key : String of the S3 key of the snapshot parquet file
+
+    Returns
+    -------
+    dict of row identifier: row digest, empty if there is no snapshot yet
+
+    """
+    import pandas as pd
+
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+    except s3_client.exceptions.NoSuchKey:
+        return {}
+    df = pd.read_parquet(BytesIO(response["Body"].read()))
+    return dict(zip(df["id"], df["digest"].tolist()))
+
+
+def write_snapshot(s3_client, bucket, key, snapshot):
+    """
+    Writes the row digest snapshot of a dataset to S3 as a parquet file sorted by row identifier
+
+    Parameters
+    ----------
+    s3_client : boto3 s3 client object
+    bucket : String of the S3 bucket
+    key : String of the S3 key of the snapshot parquet file
+    snapshot : dict of row identifier: row digest
+
+    Returns
+    -------
+    None
+
+    """
+    import pandas as pd
+
+    ids = sorted(snapshot)
+    df = pd.DataFrame(
+        {"id": pd.Series(ids, dtype="string"), "digest": [snapshot[i] for i in ids]}
+    )
+    buffer = BytesIO()
+    df.to_parquet(buffer, index=False)
+    s3_client.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
+
+
+def changed_rows(payload, id_field, snapshot):
+    """
+    Finds the rows of the payload that are new or changed since the snapshot was taken
+
+    Parameters
+    ----------
+    payload : list of dicts to upsert
+    id_field : String of the field that uniquely identifies a row
+    snapshot : dict of row identifier: row digest from the last run
+
+    Returns
+    -------
+    (list of the new or changed rows, dict of row identifier: row digest of those rows)
+
+    """
+    rows = []
+    digests = {}
+    for row in payload:
+        row_id = str(normalize_number(row[id_field]))
+        digest = row_digest(row)
+        if snapshot.get(row_id) != digest:
+            rows.append(row)
+            digests[row_id] = digest
+    return rows, digests
@@ -0,0 +1,74 @@
+"""
+Micro-benchmark of the CSR date columns. For each column, compares the format inferring to_datetime,
+strftime and where that transform used to run with parse_date_column and format_dates, on synthetic
+dates in the format of the CSV export.
+
+Ex: python benchmark_dates.py --rows 500000
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from csr_to_socrata import DATE_COLS, DATE_FORMAT, format_dates, parse_date_column
+
+
+def build_column(count, rng, missing):
+    """Returns synthetic dates as strings, with a share of them missing and many repeated timestamps"""
+    # CSRs are often created and updated in bulk, so many of them share a timestamp
+    seconds = rng.integers(0, 10 * 365 * 24 * 3600, count // 4)
+    dates = pd.Timestamp("2015-01-01") + pd.to_timedelta(rng.choice(seconds, count), unit="s")
+    values = pd.Series(dates.strftime(DATE_FORMAT), dtype=object)
+    return values.where(rng.random(count) >= missing, None)
+
+
+def old_dates(values):
+    """The date handling of one column, as it was in transform"""
+    values = pd.to_datetime(values)
+    values = values.dt.strftime("%Y-%m-%dT%H:%M:%S")
+    return values.where(pd.notnull(values), None)
+
+
+def new_dates(values):
+    return format_dates(parse_date_column(values))
+
+
+def timed(func, values):
+    start = time.perf_counter()
+    result = func(values)
+    return result, time.perf_counter() - start
+
+
+def main(args):
+    rng = np.random.default_rng(0)
+    # Columns that are only filled in for some CSRs, like Close Date, have more missing values
+    missing = {"Close Date": 0.4, "Overdue On Date": 0.2}
+
+    print(f"{args.rows} rows")
+    for col in DATE_COLS:
+        values = build_column(args.rows, rng, missing.get(col, 0.01))
+        expected, old = timed(old_dates, values)
+        result, new = timed(new_dates, values)
+
+        # Newer pandas versions return NaN instead of None for the missing strftime results
+        expected = expected.astype(object).where(expected.notna(), None)
+        if result.tolist() != expected.tolist():
+            raise AssertionError(f"{col} does not match the old date handling")
+        print(f"    {col:<20} {old:8.3f} s -> {new:8.3f} s ({old / new:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=500000,
+        help="Number of dates in each column, defaults to 500000",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
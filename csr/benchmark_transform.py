@@ -0,0 +1,81 @@
+"""
+Benchmark of the location and fiscal year derivations in the CSR transform. Compares the row at a
+time df.apply that csr_to_socrata.py used to run with the columnar build_points and get_fiscal_years,
+on synthetic CSRs.
+
+Ex: python benchmark_transform.py --rows 500000
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from csr_to_socrata import (
+    build_point_data,
+    build_points,
+    get_fiscal_year,
+    get_fiscal_years,
+)
+
+
+def build_frame(count):
+    """Returns synthetic CSRs with WGS-84 coordinates, some missing, and created dates"""
+    rng = np.random.default_rng(0)
+    latitude = rng.uniform(30.0, 30.6, count)
+    longitude = rng.uniform(-98.0, -97.5, count)
+    latitude[rng.random(count) < 0.05] = np.nan
+    longitude[rng.random(count) < 0.05] = np.nan
+    created = pd.Timestamp("2015-01-01") + pd.to_timedelta(
+        rng.integers(0, 10 * 365 * 24 * 3600, count), unit="s"
+    )
+    return pd.DataFrame(
+        {"latitude": latitude, "longitude": longitude, "datetime": created}
+    )
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main(args):
+    df = build_frame(args.rows)
+
+    expected_points, apply_points = timed(df.apply, build_point_data, 1)
+    points, columnar_points = timed(build_points, df["latitude"], df["longitude"])
+    # Newer pandas versions turn the None of build_point_data into NaN when apply builds a string column
+    expected_points = expected_points.astype(object).where(expected_points.notna(), None)
+    if points.tolist() != expected_points.tolist():
+        raise AssertionError("build_points does not match build_point_data")
+
+    expected_years, apply_years = timed(df.apply, get_fiscal_year, 1)
+    years, columnar_years = timed(get_fiscal_years, df["datetime"])
+    if years.tolist() != expected_years.tolist():
+        raise AssertionError("get_fiscal_years does not match get_fiscal_year")
+
+    apply_total = apply_points + apply_years
+    columnar_total = columnar_points + columnar_years
+    print(f"{args.rows} rows")
+    print(f"    location, row at a time: {apply_points:8.3f} s")
+    print(f"    location, columnar:      {columnar_points:8.3f} s ({apply_points / columnar_points:.1f}x faster)")
+    print(f"    fiscal year, row at a time: {apply_years:8.3f} s")
+    print(f"    fiscal year, columnar:      {columnar_years:8.3f} s ({apply_years / columnar_years:.1f}x faster)")
+    print(f"    total: {apply_total:8.3f} s -> {columnar_total:8.3f} s ({apply_total / columnar_total:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=500000,
+        help="Number of CSRs to transform, defaults to 500000",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
@@ -2,14 +2,23 @@
 Downloads CSR data from a CSV report endpoint and then uploads the data to a Socrata dataset
 """
 
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from io import BytesIO
+import json
 import os
 import logging
+import threading
+from urllib.request import urlopen
 
 import pandas as pd
 import numpy as np
 from sodapy import Socrata
 from pyproj import Transformer
+import boto3
 
+from common import socrata_utils
 import utils
 
 # Socrata Secrets
@@ -19,9 +28,35 @@ SO_KEY = os.getenv("SO_KEY")
 SO_SECRET = os.getenv("SO_SECRET")
 DATASET = os.getenv("CSR_DATASET")
 
+# AWS Secrets, the snapshot of row digests used to only upsert changed CSRs is kept in this bucket
+AWS_ACCESS_ID = os.getenv("AWS_ACCESS_KEY")
+AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+BUCKET = os.getenv("BUCKET_NAME")
+
+# Local directory or s3://bucket/prefix where acknowledged upsert batches are recorded,
+# a rerun with the same --run-id resumes from the first batch that was not acknowledged
+CHECKPOINT_PATH = os.getenv("CHECKPOINT_PATH", "checkpoints")
+
 # CSR CSV data endpoint
 ENDPOINT = os.getenv("CSR_ENDPOINT")
 
+# Date columns of the CSV export, and their format. Dates that do not match the format have it inferred instead.
+DATE_COLS = [
+    "Status Change Date",
+    "Created Date",
+    "Overdue On Date",
+    "Last Update Date",
+    "Close Date",
+]
+DATE_FORMAT = os.getenv("CSR_DATE_FORMAT", "%m/%d/%Y %I:%M:%S %p")
+
+# Coordinates are projected in chunks of this many CSRs, with this many threads
+PROJECTION_CHUNK_SIZE = 100000
+PROJECTION_WORKERS = 4
+
+# pyproj transformers are not thread safe, so each thread builds its own once and reuses it
+transformers = threading.local()
+
 FIELD_MAPPING = {
     "Service Request (SR) Number": "service_request_sr_number",
     "Department": "department",
@@ -63,18 +98,262 @@ def extract():
     logger.info(f"Downloaded {len(df)} CSRs from endpoint")
     return df
 
-def convert_from_state_plane(df):
+
+def extract_chunks(chunk_size):
+    """
+    Streams the CSRs from the CSV endpoint, yielding dataframes of chunk_size rows as they are downloaded
+    """
+    total = 0
+    with urlopen(ENDPOINT) as response:
+        try:
+            for chunk in pd.read_csv(
+                response, sep="\t", encoding="utf_16", chunksize=chunk_size
+            ):
+                total += len(chunk)
+                yield chunk
+        except UnicodeError as e:
+            logger.info("Unexpected file type returned from the CSV endpoint. Check that you are on the city network. "
+                        "It's likely that your request is getting flagged as a bot by the web app firewall.")
+            raise e
+    logger.info(f"Downloaded {total} CSRs from endpoint")
+
+
+def get_watermark(s3_client):
+    """
+    Returns the watermark of the last incremental run, which holds the latest Last Update Date
+    that was upserted and when the last full reconcile ran
+
+    Parameters
+    ----------
+    s3_client : boto3 s3 client object
+
+    Returns
+    -------
+    dict of "last_update_date" and "full_reconcile" datetimes, empty if no watermark has been stored yet
+
+    """
+    try:
+        response = s3_client.get_object(Bucket=BUCKET, Key=f"watermarks/{DATASET}.json")
+    except s3_client.exceptions.NoSuchKey:
+        return {}
+    body = json.loads(response["Body"].read())
+    return {key: datetime.fromisoformat(body[key]) for key in ["last_update_date", "full_reconcile"]}
+
+
+def set_watermark(s3_client, watermark):
+    """
+    Stores the watermark for the next incremental run
+
+    Parameters
+    ----------
+    s3_client : boto3 s3 client object
+    watermark : dict of "last_update_date" and "full_reconcile" datetimes
+
+    """
+    logger.info(f"Setting watermark to {watermark}")
+    body = {key: value.isoformat() for key, value in watermark.items()}
+    body["updated_at"] = datetime.now().isoformat()
+    s3_client.put_object(
+        Bucket=BUCKET, Key=f"watermarks/{DATASET}.json", Body=json.dumps(body)
+    )
+
+
+def parse_date_column(values):
+    """
+    Parses a column of dates from the CSV export. Parsing with an explicit format and caching the repeated
+    timestamps is much faster than letting pandas infer the format.
+    """
+    parsed = pd.to_datetime(values, format=DATE_FORMAT, errors="coerce", cache=True)
+    unparsed = parsed.isna() & values.notna()
+    if unparsed.any():
+        parsed[unparsed] = pd.to_datetime(values[unparsed], cache=True)
+    return parsed
+
+
+def parse_dates(df):
+    """
+    Parses each of the date columns once, in place
+    """
+    for col in DATE_COLS:
+        df[col] = parse_date_column(df[col])
+    return df
+
+
+def format_dates(dates):
+    """
+    Formats a parsed date column as the ISO strings expected by Socrata, with None for missing dates
+    """
+    strings = dates.to_numpy(dtype="datetime64[s]").astype(str)
+    return pd.Series(strings, index=dates.index, dtype=object).where(dates.notna(), None)
+
+
+def updated_since(df, since, latest):
+    """
+    Filters the CSRs down to the ones last updated at or after since. CSRs without a Last Update Date are kept.
+
+    Parameters
+    ----------
+    df : Pandas Dataframe of CSRs with parsed dates
+    since : datetime or None to keep every CSR
+    latest : list that the latest Last Update Date of the CSRs is appended to
+
+    Returns
+    -------
+    Pandas Dataframe
+
+    """
+    updated = df["Last Update Date"]
+    if updated.notna().any():
+        latest.append(updated.max())
+    if since is None:
+        return df
+    df = df[updated.isna() | (updated >= since)]
+    logger.info(f"{len(df)} of {len(updated)} CSRs were updated since {since}")
+    return df
+
+
+def get_transformer():
+    """
+    Returns the state plane to WGS-84 transformer of the current thread
+    """
+    if not hasattr(transformers, "transformer"):
+        transformers.transformer = Transformer.from_crs(
+            crs_from="ESRI:102739", crs_to="EPSG:4326"
+        )
+    return transformers.transformer
+
+
+def project(x, y):
+    """
+    Projects state plane coordinates to WGS-84. Large arrays are split into chunks that are projected
+    in parallel threads, since pyproj releases the GIL while it transforms.
+
+    Parameters
+    ----------
+    x: numpy array of state plane X coordinates
+    y: numpy array of state plane Y coordinates
+
+    Returns
+    -------
+    (numpy array of latitudes, numpy array of longitudes)
+
+    """
+    if len(x) <= PROJECTION_CHUNK_SIZE:
+        return get_transformer().transform(x, y)
+
+    def project_chunk(start):
+        end = start + PROJECTION_CHUNK_SIZE
+        return get_transformer().transform(x[start:end], y[start:end])
+
+    with ThreadPoolExecutor(max_workers=PROJECTION_WORKERS) as executor:
+        chunks = list(executor.map(project_chunk, range(0, len(x), PROJECTION_CHUNK_SIZE)))
+    return (
+        np.concatenate([chunk[0] for chunk in chunks]),
+        np.concatenate([chunk[1] for chunk in chunks]),
+    )
+
+
+def read_coordinate_cache(s3_client):
+    """
+    Reads the coordinates projected by the last full run
+
+    Parameters
+    ----------
+    s3_client : boto3 s3 client object
+
+    Returns
+    -------
+    dict of "previous": Pandas Dataframe of the latitude and longitude of each pair of state plane
+        coordinates, indexed by x and y, and "updates": list that the coordinates of this run are added to
+
+    """
+    previous = pd.DataFrame(
+        columns=["latitude", "longitude"],
+        index=pd.MultiIndex.from_arrays([[], []], names=["x", "y"]),
+        dtype=float,
+    )
+    try:
+        response = s3_client.get_object(Bucket=BUCKET, Key=f"coordinates/{DATASET}.parquet")
+        previous = pd.read_parquet(BytesIO(response["Body"].read())).set_index(["x", "y"])
+    except s3_client.exceptions.NoSuchKey:
+        pass
+    return {"previous": previous, "updates": []}
+
+
+def write_coordinate_cache(s3_client, coordinate_cache):
+    """
+    Writes the coordinates seen by this run, so coordinates that no CSR has anymore are dropped
+    """
+    coordinates = pd.concat(coordinate_cache["updates"])
+    coordinates = coordinates[~coordinates.index.duplicated(keep="last")]
+    buffer = BytesIO()
+    coordinates.reset_index().to_parquet(buffer, index=False)
+    s3_client.put_object(
+        Bucket=BUCKET, Key=f"coordinates/{DATASET}.parquet", Body=buffer.getvalue()
+    )
+
+
+def convert_from_state_plane(df, coordinate_cache=None):
     """
-    Adds a WGS-84 lat/long column to the dataframe based on the state plane coordinates.
+    Adds a WGS-84 lat/long column to the dataframe based on the state plane coordinates. Coordinates
+    that are in the coordinate cache reuse the lat/long projected by the last run.
     """
+    x = df["State Plane X Coordinate"].to_numpy(dtype=float)
+    y = df["State Plane Y Coordinate"].to_numpy(dtype=float)
+    latitude = np.full(len(df), np.nan)
+    longitude = np.full(len(df), np.nan)
+    todo = np.ones(len(df), dtype=bool)
+
+    if coordinate_cache is not None:
+        cached = coordinate_cache["previous"].reindex(pd.MultiIndex.from_arrays([x, y]))
+        hit = cached["latitude"].notna().to_numpy()
+        latitude[hit] = cached["latitude"].to_numpy()[hit]
+        longitude[hit] = cached["longitude"].to_numpy()[hit]
+        todo = ~hit
+
     # projection of coordinates
-    transformer = Transformer.from_crs(crs_from="ESRI:102739", crs_to="EPSG:4326")
-    df["latitude"], df["longitude"] = transformer.transform(df["State Plane X Coordinate"].tolist(), df["State Plane Y Coordinate"].tolist())
+    latitude[todo], longitude[todo] = project(x[todo], y[todo])
+    df["latitude"], df["longitude"] = latitude, longitude
+
+    if coordinate_cache is not None:
+        logger.info(f"Reused the cached coordinates of {hit.sum()} of {len(df)} CSRs")
+        seen = np.isfinite(latitude) & np.isfinite(longitude)
+        coordinate_cache["updates"].append(
+            pd.DataFrame(
+                {"latitude": latitude[seen], "longitude": longitude[seen]},
+                index=pd.MultiIndex.from_arrays([x[seen], y[seen]], names=["x", "y"]),
+            )
+        )
+
     # Create wgs84 location columns in socrata format
-    df["location"] = df.apply(build_point_data, axis=1)
+    df["location"] = build_points(df["latitude"], df["longitude"])
     return df
 
 
+def build_points(latitude, longitude):
+    """
+    Same as build_point_data, for whole columns at a time
+
+    Parameters
+    ----------
+    latitude: pandas Series of WGS-84 latitudes
+    longitude: pandas Series of WGS-84 longitudes
+
+    Returns
+    -------
+    pandas Series of point datatypes formatted as expected by Socrata, None where there is no location data.
+
+    """
+    valid = (latitude.notna() & longitude.notna()).to_numpy()
+    # Formatting the floats is the only per-value work left, and it is cheapest on plain python floats
+    x = longitude.to_numpy()[valid].tolist()
+    y = latitude.to_numpy()[valid].tolist()
+
+    points = np.full(len(valid), None, dtype=object)
+    points[valid] = [f"POINT ({lon} {lat})" for lon, lat in zip(x, y)]
+    return pd.Series(points, index=latitude.index, dtype=object)
+
+
 def build_point_data(row):
     """
 
@@ -106,27 +385,22 @@ def get_fiscal_year(row):
     return fiscal_year
 
 
-def transform(df):
+def get_fiscal_years(dates):
+    """
+    Same as get_fiscal_year, for a whole datetime column at a time
+    """
+    return dates.dt.year + (dates.dt.month >= 10)
+
+
+def transform(df, coordinate_cache=None):
     logger.info("Transforming CSR data")
-    df = convert_from_state_plane(df)
+    df = convert_from_state_plane(df, coordinate_cache)
 
-    # Converting datetime to correct format for socrata
-    date_cols = [
-        "Status Change Date",
-        "Created Date",
-        "Overdue On Date",
-        "Last Update Date",
-        "Close Date",
-    ]
+    df["fiscal_year"] = get_fiscal_years(df["Created Date"])
 
     # date column formatting to match format expected by Socrata
-    for col in date_cols:
-        df[col] = pd.to_datetime(df[col])
-        df[col] = df[col].dt.strftime("%Y-%m-%dT%H:%M:%S")
-        df[col] = df[col].where(pd.notnull(df[col]), None)
-
-    df["datetime"] = pd.to_datetime(df["Created Date"])
-    df["fiscal_year"] = df.apply(get_fiscal_year, axis=1)
+    for col in DATE_COLS:
+        df[col] = format_dates(df[col])
 
     # Field mapping
     df = df[list(FIELD_MAPPING.keys())]
@@ -145,14 +419,40 @@ def transform(df):
     return payload
 
 
-def load(client, data):
+def load(client, data, run_id, snapshot=None, s3_client=None, batch_size=socrata_utils.BATCH_SIZE):
+    """
+    Upserts the CSRs that are new or changed since the snapshot of the last run to Socrata, and adds them
+    to the snapshot. Without a snapshot every CSR is upserted. run_id identifies the run in the upsert checkpoints,
+    and s3_client is used to store them when CHECKPOINT_PATH is an s3:// path. batch_size is the size of the
+    first upsert batch, the result has the adapted size to pass on to the next chunk.
+    """
+    if snapshot is not None:
+        total = len(data)
+        data, digests = socrata_utils.changed_rows(
+            data, "service_request_sr_number", snapshot
+        )
+        logger.info(f"{len(data)} of {total} CSRs are new or changed since the last run")
+
     logger.info("Uploading CSR data to Socrata")
-    res = client.upsert(DATASET, data)
-    logger.info(res)
+    res = socrata_utils.upsert_in_batches(
+        client,
+        DATASET,
+        data,
+        logger,
+        batch_size=batch_size,
+        checkpoint_path=CHECKPOINT_PATH,
+        run_id=run_id,
+        s3_client=s3_client,
+        id_field="service_request_sr_number",
+    )
+    logger.info({k: v for k, v in res.items() if k != "batches"})
+
+    if snapshot is not None:
+        snapshot.update(digests)
     return res
 
 
-def main():
+def main(args):
     soda = Socrata(
         SO_WEB,
         SO_TOKEN,
@@ -161,16 +461,156 @@ def main():
         timeout=500,
     )
 
-    data = extract()
-    data = transform(data)
-    res = load(soda, data)
-
+    s3_client = None
+    snapshot = None
+    if BUCKET or CHECKPOINT_PATH.startswith("s3://"):
+        s3_client = boto3.client(
+            "s3",
+            aws_access_key_id=AWS_ACCESS_ID,
+            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        )
+        snapshot_key = f"snapshots/{DATASET}.parquet"
+
+    # A full reconcile upserts every CSR, whatever the watermark and snapshot say
+    now = datetime.now()
+    since = None
+    full = args.full
+    if args.incremental:
+        watermark = get_watermark(s3_client)
+        full = full or not watermark or (
+            now - watermark["full_reconcile"] > timedelta(days=args.full_every_days)
+        )
+        if not full:
+            since = watermark["last_update_date"] - timedelta(hours=args.overlap_hours)
+    if full:
+        logger.info("Doing a full reconcile of the CSRs in Socrata")
+    if args.changed_only:
+        # The snapshot is rebuilt from scratch on a full reconcile
+        snapshot = {} if full else socrata_utils.read_snapshot(s3_client, BUCKET, snapshot_key)
+    elif BUCKET:
+        # Every CSR is upserted, so a snapshot left by an earlier run would no longer match Socrata
+        s3_client.delete_object(Bucket=BUCKET, Key=snapshot_key)
+
+    coordinate_cache = None
+    if args.coordinate_cache and since is None:
+        coordinate_cache = read_coordinate_cache(s3_client)
+    elif args.coordinate_cache:
+        # Incremental runs only project the CSRs updated since the watermark, which is cheaper
+        # than reading and rewriting the coordinates of every CSR
+        logger.info("Skipping the coordinate cache for an incremental run")
+
+    latest = []
+    if args.chunk_size:
+        # The next chunks are downloaded and transformed while the current one is upserted
+        chunks = utils.pipe(
+            lambda chunk: updated_since(parse_dates(chunk), since, latest),
+            extract_chunks(args.chunk_size),
+            args.queue_size,
+        )
+        payloads = utils.pipe(
+            lambda chunk: transform(chunk, coordinate_cache), chunks, args.queue_size
+        )
+    else:
+        df = updated_since(parse_dates(extract()), since, latest)
+        payloads = [transform(df, coordinate_cache)]
+
+    res = []
+    batch_size = socrata_utils.BATCH_SIZE
+    for data in payloads:
+        res.append(load(soda, data, args.run_id, snapshot, s3_client, batch_size))
+        # The upsert batch size keeps adapting from one chunk to the next
+        batch_size = res[-1]["batch_size"]
+
+    if snapshot is not None:
+        socrata_utils.write_snapshot(s3_client, BUCKET, snapshot_key, snapshot)
+    if coordinate_cache is not None and coordinate_cache["updates"]:
+        write_coordinate_cache(s3_client, coordinate_cache)
+    if args.incremental and latest:
+        set_watermark(
+            s3_client,
+            {
+                "last_update_date": max(latest).to_pydatetime(),
+                "full_reconcile": now if full else watermark["full_reconcile"],
+            },
+        )
     return res
 
 
 if __name__ == "__main__":
+    # CLI arguments definition
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        help="Number of CSRs to download, transform and upsert at a time. Defaults to all of them at once",
+    )
+
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=2,
+        help="Number of chunks each stage can get ahead of the next one when using --chunk-size, defaults to 2",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only upserts the CSRs updated since the Last Update Date stored as the watermark of the last run",
+    )
+
+    parser.add_argument(
+        "--overlap-hours",
+        type=int,
+        default=24,
+        help="Number of hours before the watermark to upsert again in incremental mode, defaults to 24",
+    )
+
+    parser.add_argument(
+        "--full-every-days",
+        type=int,
+        default=7,
+        help="Number of days between full reconciles in incremental mode, defaults to 7",
+    )
+
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Does a full reconcile, upserting every CSR without comparing to the last run",
+    )
+
+    parser.add_argument(
+        "--coordinate-cache",
+        action="store_true",
+        help="Reuses the lat/long projected by the last full run for state plane coordinates it has seen. "
+        "Off by default because it is not a speedup: projecting every CSR is cheaper than reading the cache "
+        "and looking the coordinates up in it. Incremental runs that are not a full reconcile never use it",
+    )
+
+    parser.add_argument(
+        "--changed-only",
+        action="store_true",
+        help="Only upserts the CSRs that changed since the last --changed-only run, "
+        "using a snapshot of row digests kept in S3",
+    )
+
+    parser.add_argument(
+        "--run-id",
+        default=datetime.now().strftime("%Y-%m-%d"),
+        help="Identifies the run in the upsert checkpoints. Rerunning with the same run ID skips the batches "
+        "that were already upserted, defaults to today's date",
+    )
+
+    args = parser.parse_args()
+    if args.incremental and not BUCKET:
+        parser.error("--incremental needs BUCKET_NAME to store the watermark")
+    if args.changed_only and not BUCKET:
+        parser.error("--changed-only needs BUCKET_NAME to store the snapshot")
+    if args.coordinate_cache and not BUCKET:
+        parser.error("--coordinate-cache needs BUCKET_NAME to store the coordinates")
+
     logger = utils.get_logger(
         __name__,
         level=logging.INFO,
     )
-    main()
+    main(args)
@@ -8,6 +8,7 @@ import logging
 import pandas as pd
 from sodapy import Socrata
 
+from common import socrata_utils
 import utils
 
 # Socrata Secrets
@@ -73,8 +74,10 @@ def transform(df):
 
 def load(client, data):
     logger.info("Uploading CSR data to Socrata")
-    res = client.upsert(DATASET, data)
-    logger.info(res)
+    res = socrata_utils.upsert_in_batches(
+        client, DATASET, data, logger, id_field="flex_note_id"
+    )
+    logger.info({k: v for k, v in res.items() if k != "batches"})
     return res
 
 
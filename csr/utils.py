@@ -1,5 +1,7 @@
 import logging
+import queue
 import sys
+import threading
 
 
 def get_logger(name, level):
@@ -11,3 +13,61 @@ def get_logger(name, level):
     logger.addHandler(handler)
     logger.setLevel(level)
     return logger
+
+
+def pipe(func, items, queue_size):
+    """
+    Applies func to each item in a background thread. The results are yielded in order, and at most
+    queue_size of them wait to be consumed, so chaining pipes makes a bounded producer/consumer pipeline
+    where every stage works at the same time.
+
+    Parameters
+    ----------
+    func : function to apply to each item
+    items : iterable of items, it is consumed by the background thread
+    queue_size : Int number of results that can wait to be consumed
+
+    Returns
+    -------
+    generator of the results of func, an exception raised by the background thread is raised again here.
+    The background thread stops once the generator is closed or the consumer raises.
+
+    """
+    results = queue.Queue(maxsize=queue_size)
+    # Set when the consumer stops early, so the background thread doesn't wait forever on a full queue
+    stopped = threading.Event()
+
+    def put(result):
+        while not stopped.is_set():
+            try:
+                results.put(result, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def work():
+        try:
+            for item in items:
+                if not put((True, func(item))):
+                    return
+        except Exception as e:
+            put((False, e))
+            return
+        finally:
+            # Stops the stage before this one when items is another pipe
+            if hasattr(items, "close"):
+                items.close()
+        put((False, None))
+
+    threading.Thread(target=work, daemon=True).start()
+    try:
+        while True:
+            ok, result = results.get()
+            if not ok:
+                if result is not None:
+                    raise result
+                return
+            yield result
+    finally:
+        stopped.set()
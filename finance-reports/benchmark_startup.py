@@ -0,0 +1,94 @@
+"""
+Measures the startup time of each finance entry point by running it with --help under
+python -X importtime, and reports the total time and the slowest imports.
+
+Ex: python benchmark_startup.py --top 10
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ENTRY_POINTS = [
+    "mstro_reports_to_socrata.py",
+    "rev_exp_report_to_s3.py",
+]
+
+
+def parse_importtime(stderr):
+    """
+    Returns (cumulative microseconds, module name, depth) tuples from the -X importtime output.
+    Depth is 0 for modules imported directly by the script or the interpreter.
+    """
+    imports = []
+    for line in stderr.splitlines():
+        # Lines look like: import time:       self [us] |  cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:") :].split("|")
+        # Nested imports are indented by two spaces for each level
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        imports.append((int(cumulative), module.strip(), depth))
+    return imports
+
+
+def benchmark_entry_point(script, runs):
+    """
+    Runs the script with --help and returns the best wall time in seconds and its imports
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    # The scripts import the shared helpers in common/ from the root of the repo, see the Dockerfile
+    root = os.path.dirname(here)
+    pythonpath = os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")]))
+    env = {**os.environ, "PYTHONPATH": pythonpath}
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", script, "--help"],
+            cwd=here,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        elapsed = time.perf_counter() - start
+        if result.returncode != 0:
+            raise RuntimeError(f"{script} --help failed:\n{result.stderr}")
+        if best is None or elapsed < best[0]:
+            best = (elapsed, parse_importtime(result.stderr))
+    return best
+
+
+def main(args):
+    for script in ENTRY_POINTS:
+        elapsed, imports = benchmark_entry_point(script, args.runs)
+        # Only top level imports, since cumulative times include the nested imports
+        top_level = [i for i in imports if i[2] == 0]
+        total = sum(i[0] for i in top_level)
+        print(f"{script}: {elapsed:.3f} s wall, {total / 1e6:.3f} s importing")
+        for cumulative, module, _ in sorted(top_level, reverse=True)[: args.top]:
+            print(f"    {cumulative / 1e6:8.3f} s  {module}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=3,
+        help="Number of times to run each entry point, the fastest run is reported. Defaults to 3",
+    )
+
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=10,
+        help="Number of the slowest imports to show, defaults to 10",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
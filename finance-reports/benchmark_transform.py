@@ -0,0 +1,95 @@
+"""
+Benchmark of deriving the finance fields for a report file. Compares the row at a time loop
+that mstro_reports_to_socrata.py used to run with transform_batch, which derives the fields
+that are the same for the whole file once, on synthetic expense report rows.
+
+Ex: python benchmark_transform.py --rows 100000
+"""
+
+import argparse
+from datetime import datetime
+import random
+import time
+
+from config import EXPENSES_FIELD_MAPPING, EXPENSES_ID_COLUMN, EXPENSES_NUMERIC_COLS
+from mstro_reports_to_socrata import (
+    create_row_identifier,
+    get_fiscal_month,
+    get_fiscal_year,
+    transform_batch,
+)
+
+YEAR = 2023
+MONTH = 9
+DEPARTMENT = 2400
+
+
+def build_rows(count):
+    """Returns synthetic rows in the form get_csv_data used to return them, as dicts of strings"""
+    rng = random.Random(0)
+    rows = []
+    for i in range(count):
+        row = {new_key: f"value {i}" for new_key in EXPENSES_FIELD_MAPPING.values()}
+        for col in ["fund", "unit", "object_code"]:
+            row[col] = str(rng.randrange(1000, 9999))
+        for col in EXPENSES_NUMERIC_COLS:
+            row[col] = "" if rng.random() < 0.2 else f"{rng.uniform(-1e6, 1e6):.2f}"
+        rows.append(row)
+    return rows
+
+
+def transform_rows(data):
+    """The row at a time transform, as it was in main"""
+    for row in data:
+        row["year"] = YEAR
+        row["month"] = MONTH
+        row["department"] = DEPARTMENT
+
+        # Derived fields
+        row["month_name"] = datetime(2022, row["month"], 1).strftime("%b")
+        row["fiscal_year"] = get_fiscal_year(row["year"], row["month"])
+        row["fiscal_month"] = get_fiscal_month(row["month"])
+        row["row_identifier"] = create_row_identifier(row, EXPENSES_ID_COLUMN)
+
+        # Convert empty strings to None for numeric fields
+        for key in EXPENSES_NUMERIC_COLS:
+            if row[key] == "":
+                row[key] = None
+    return data
+
+
+def main(args):
+    rows = build_rows(args.rows)
+
+    start = time.perf_counter()
+    expected = transform_rows([dict(row) for row in rows])
+    loop = time.perf_counter() - start
+
+    data = [dict(row) for row in rows]
+    start = time.perf_counter()
+    result = transform_batch(
+        data, YEAR, MONTH, DEPARTMENT, EXPENSES_ID_COLUMN, EXPENSES_NUMERIC_COLS
+    )
+    batch = time.perf_counter() - start
+
+    if result != expected:
+        raise AssertionError("transform_batch does not match the row at a time transform")
+
+    print(f"{args.rows} rows")
+    print(f"    row at a time: {loop:8.3f} s")
+    print(f"    transform_batch: {batch:8.3f} s ({loop / batch:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=100000,
+        help="Number of report rows to transform, defaults to 100000",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
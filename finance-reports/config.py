@@ -77,4 +77,15 @@ EXPENSES_ID_COLUMN = [
     "department",
     "unit",
     "object_code",
-]
\ No newline at end of file
+]
+
+# pandas dtypes of the report columns stored in S3. Codes are text even when they look like numbers.
+EXPENSES_DTYPES = {
+    col: "float64" if name in EXPENSES_NUMERIC_COLS else "string"
+    for col, name in EXPENSES_FIELD_MAPPING.items()
+}
+
+REVENUE_DTYPES = {
+    col: "float64" if name in REVENUE_NUMERIC_COLS else "string"
+    for col, name in REVENUE_FIELD_MAPPING.items()
+}
@@ -1,20 +1,23 @@
 import argparse
+import calendar
+import codecs
 import csv
 from datetime import datetime
-from io import StringIO
+import gzip
 import os
 import logging
 
-import boto3
-from sodapy import Socrata
-
+from config import EXPENSES_DTYPES
 from config import EXPENSES_FIELD_MAPPING
 from config import EXPENSES_ID_COLUMN
 from config import EXPENSES_NUMERIC_COLS
+from config import REVENUE_DTYPES
 from config import REVENUE_FIELD_MAPPING
 from config import REVENUE_ID_COLUMN
 from config import REVENUE_NUMERIC_COLS
 
+from common import s3_utils
+from common import socrata_utils
 import utils
 
 # AWS Credentials
@@ -30,6 +33,10 @@ SO_SECRET = os.getenv("SO_SECRET")
 EXP_DATASET = os.getenv("EXP_DATASET")
 REV_DATASET = os.getenv("REV_DATASET")
 
+# Local directory or s3://bucket/prefix where acknowledged upsert batches are recorded
+CHECKPOINT_PATH = os.getenv("CHECKPOINT_PATH", "checkpoints")
+
+
 def select_month(year, month):
     """
     Parameters
@@ -59,33 +66,138 @@ def select_month(year, month):
     return f_year, f_month
 
 
-def list_s3_files(s3_client, subdir):
-    file_names = []
+def list_s3_files(s3_client, subdir, months=None):
+    """
+    Returns an index of the report files in a subdirectory of the bucket. Keys are named
+    like expenses/2023-09-30_2400.csv, and listing is paginated so it is not limited to 1000 keys.
 
-    # List objects in the bucket
-    response = s3_client.list_objects_v2(Bucket=BUCKET, Prefix=subdir)
+    Parameters
+    ----------
+    s3_client : boto3 s3 client
+    subdir : String of the subdirectory, ex: expenses/
+    months : list of (year, month) tuples, if given only the keys for these months are listed
 
-    # Add file names to the list
-    for obj in response.get("Contents", []):
-        file_names.append(obj["Key"])
+    Returns
+    -------
+    dict: the key of each file by (year, month, department). If a report is stored in more than one
+        format, the most recently modified one is used.
 
-    return file_names
+    """
+    if months:
+        prefixes = [f"{subdir}{year}-{month:02d}" for year, month in months]
+    else:
+        prefixes = [subdir]
+
+    latest = {}
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for prefix in prefixes:
+        for page in paginator.paginate(Bucket=BUCKET, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                name = strip_extension(obj["Key"])[len(subdir) :]
+                # Skip anything that is not named like a report, such as the folder itself
+                if "_" not in name:
+                    continue
+                date, department = name.split("_")
+                report = (int(date[0:4]), int(date[5:7]), int(department))
+                if report not in latest or obj["LastModified"] > latest[report][0]:
+                    latest[report] = (obj["LastModified"], obj["Key"])
+
+    return {report: key for report, (_, key) in latest.items()}
+
+
+def strip_extension(filename):
+    # Removes the file extension of any of the output formats from a key
+    for ext in sorted(s3_utils.OUTPUT_FORMATS.values(), key=len, reverse=True):
+        if filename.endswith(ext):
+            return filename[: -len(ext)]
+    return filename
+
+
+def build_projection(header, field_mapping):
+    """
+    Returns a function that maps a CSV row to a dict of Socrata columns. Column positions are looked up
+    once from the header, and columns that are missing from the file are None.
 
+    Parameters
+    ----------
+    header : list of the column names in the CSV file
+    field_mapping : dict of CSV column names to Socrata column names
 
-def get_csv_data(s3_client, filename, field_mapping):
-    response = s3_client.get_object(Bucket=BUCKET, Key=filename)
-    csv_content = response["Body"].read().decode("utf-8")
-    csv_data = csv.DictReader(StringIO(csv_content))
+    """
+    present = [(new_key, header.index(key)) for key, new_key in field_mapping.items() if key in header]
+    missing = [new_key for key, new_key in field_mapping.items() if key not in header]
+    new_keys = [new_key for new_key, _ in present] + missing
+    positions = [position for _, position in present]
+    width = max(positions, default=-1) + 1
+    fill = [None] * len(missing)
+
+    def project(row):
+        # Short rows are padded with None, like csv.DictReader does
+        if len(row) < width:
+            row = row + [None] * (width - len(row))
+        return dict(zip(new_keys, [row[i] for i in positions] + fill))
 
-    # Field mapping to Socrata columns
-    mapped_data = []
-    for row in csv_data:
-        mapped_row = {}
-        for original_key, new_key in field_mapping.items():
-            mapped_row[new_key] = row.get(original_key)
-        mapped_data.append(mapped_row)
+    return project
+
+
+def get_csv_data(s3_client, filename, field_mapping, dtypes, batch_size):
+    """
+    Yields batches of rows from a report file in S3, mapped to Socrata columns. CSV files are decoded
+    and parsed as they are read from S3, so only one batch of rows is held in memory. CSV values are
+    kept as strings, and the text columns of Parquet files are read the same way so both give the
+    same row identifiers.
+
+    Parameters
+    ----------
+    s3_client : boto3 s3 client
+    filename : String of the key of the report file
+    field_mapping : dict of report column names to Socrata column names
+    dtypes : dict of report column names to the pandas dtypes they are stored as
+    batch_size : Int number of rows in each batch
+
+    """
+    response = s3_client.get_object(Bucket=BUCKET, Key=filename)
+    if filename.endswith(s3_utils.OUTPUT_FORMATS["parquet"]):
+        text_cols = [col for col, dtype in dtypes.items() if dtype == "string"]
+        # Parquet files can't be read in pieces from a stream
+        df = s3_utils.read_df(
+            response["Body"], filename, dtype=dict.fromkeys(text_cols, str)
+        )
+        text_cols = [col for col in text_cols if col in df.columns]
+        df[text_cols] = df[text_cols].fillna("")
+        # Missing values become None instead of NaN. The columns are converted to lists and zipped
+        # into rows, which is much cheaper than having pandas build a dict per row.
+        columns = [
+            df[key].astype(object).where(df[key].notna(), None).tolist()
+            if key in df.columns
+            else [None] * len(df)
+            for key in field_mapping
+        ]
+        new_keys = list(field_mapping.values())
+        for i in range(0, len(df), batch_size):
+            values = zip(*(column[i : i + batch_size] for column in columns))
+            yield [dict(zip(new_keys, row)) for row in values]
+        return
+
+    body = response["Body"]
+    if filename.endswith(s3_utils.OUTPUT_FORMATS["csv.gz"]):
+        body = gzip.GzipFile(fileobj=body)
+    reader = csv.reader(codecs.getreader("utf-8")(body))
+
+    header = next(reader, None)
+    if header is None:
+        return
+    project = build_projection(header, field_mapping)
+
+    batch = []
+    for row in reader:
+        batch.append(project(row))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-    return mapped_data
 
 def get_fiscal_year(year, month):
     if month >= 10:
@@ -112,7 +224,60 @@ def create_row_identifier(row, id_cols):
     return output
 
 
+def transform_batch(data, year, month, department, id_cols, numeric_cols):
+    """
+    Adds the derived fields to a batch of report rows, in place. The date fields are the same for
+    every row of a file, so they are computed once per batch instead of once per row.
+
+    Parameters
+    ----------
+    data : list of dicts from get_csv_data
+    year : Int calendar year of the report
+    month : Int calendar month of the report
+    department : Int department of the report
+    id_cols : list of the columns that make up the row identifier
+    numeric_cols : list of the numeric columns
+
+    Returns
+    -------
+    list of dicts: the rows to upsert to Socrata
+
+    """
+    derived = {
+        "year": year,
+        "month": month,
+        "department": department,
+        "month_name": calendar.month_abbr[month],
+        "fiscal_year": get_fiscal_year(year, month),
+        "fiscal_month": get_fiscal_month(month),
+    }
+    for row in data:
+        row.update(derived)
+        # Same as create_row_identifier
+        row["row_identifier"] = "".join([str(row[col]) for col in id_cols])
+
+        # Convert empty strings to None for numeric fields
+        for key in numeric_cols:
+            if row[key] == "":
+                row[key] = None
+    return data
+
+
+def read_snapshot(s3_client, snapshot_key, changed_only):
+    """
+    Returns the row digest snapshot of a dataset when only changed rows are upserted, otherwise None.
+    A run that upserts every row deletes the snapshot instead, since it would no longer match Socrata.
+    """
+    if changed_only:
+        return socrata_utils.read_snapshot(s3_client, BUCKET, snapshot_key)
+    s3_client.delete_object(Bucket=BUCKET, Key=snapshot_key)
+    return None
+
+
 def main(args):
+    import boto3
+    from sodapy import Socrata
+
     s3_client = boto3.client(
         "s3",
         aws_access_key_id=AWS_ACCESS_ID,
@@ -132,62 +297,86 @@ def main(args):
         prev_month = month - 1
         prev_year = year
 
-    selected_months = [f"{year}-{month}", f"{prev_year}-{prev_month}"]
+    # All months are listed when replacing
+    selected_months = None if args.replace else [(year, month), (prev_year, prev_month)]
 
     # Expenses
-    payload = []
-    files = list_s3_files(s3_client, "expenses/")
-    for f in files:
-        f_year = int(f[9:13])
-        f_month = int(f[14:16])
-        if f"{f_year}-{f_month}" in selected_months or args.replace:
-            data = get_csv_data(s3_client, f, EXPENSES_FIELD_MAPPING)
-
-            for row in data:
-                row["year"] = f_year
-                row["month"] = f_month
-
-                row["department"] = int(f[-8:-4])
-
-                # Derived fields
-                row["month_name"] = datetime(2022, row["month"], 1).strftime("%b")
-                row["fiscal_year"] = get_fiscal_year(row["year"], row["month"])
-                row["fiscal_month"] = get_fiscal_month(row["month"])
-                row["row_identifier"] = create_row_identifier(row, EXPENSES_ID_COLUMN)
-
-                # Convert empty strings to None for numeric fields
-                for key in EXPENSES_NUMERIC_COLS:
-                    if row[key] == "":
-                        row[key] = None
-
-            res = soda.upsert(EXP_DATASET, data)
+    files = list_s3_files(s3_client, "expenses/", selected_months)
+    snapshot_key = f"snapshots/{EXP_DATASET}.parquet"
+    snapshot = read_snapshot(s3_client, snapshot_key, args.changed_only)
+    # The upsert batch size keeps adapting from one read batch and file to the next
+    upsert_batch_size = socrata_utils.BATCH_SIZE
+    for (f_year, f_month, f_department), f in sorted(files.items()):
+        batches = get_csv_data(
+            s3_client, f, EXPENSES_FIELD_MAPPING, EXPENSES_DTYPES, args.batch_size
+        )
+        for data in batches:
+            data = transform_batch(
+                data, f_year, f_month, f_department, EXPENSES_ID_COLUMN, EXPENSES_NUMERIC_COLS
+            )
+            if snapshot is not None:
+                # Only rows that are new or changed since the last run are sent to Socrata
+                data, digests = socrata_utils.changed_rows(data, "row_identifier", snapshot)
+                if not data:
+                    continue
+            res = socrata_utils.upsert_in_batches(
+                soda,
+                EXP_DATASET,
+                data,
+                logger,
+                batch_size=upsert_batch_size,
+                workers=args.workers,
+                checkpoint_path=CHECKPOINT_PATH,
+                run_id=args.run_id,
+                s3_client=s3_client,
+                id_field="row_identifier",
+            )
+            res.pop("batches")
+            upsert_batch_size = res["batch_size"]
+            if snapshot is not None:
+                snapshot.update(digests)
             logger.info(f"Expenses Socrata Response: {f},{res}")
+    if snapshot is not None:
+        socrata_utils.write_snapshot(s3_client, BUCKET, snapshot_key, snapshot)
 
     # Revenue
-    files = list_s3_files(s3_client, "revenue/")
-    for f in files:
-        f_year = int(f[8:12])
-        f_month = int(f[13:15])
-        if f"{f_year}-{f_month}" in selected_months or args.replace:
-            data = get_csv_data(s3_client, f, REVENUE_FIELD_MAPPING)
-            for row in data:
-                row["year"] = f_year
-                row["month"] = f_month
-                row["department"] = int(f[-8:-4])
-
-                # Derived fields
-                row["month_name"] = datetime(2022, row["month"], 1).strftime("%b")
-                row["fiscal_year"] = get_fiscal_year(row["year"], row["month"])
-                row["fiscal_month"] = get_fiscal_month(row["month"])
-                row["row_identifier"] = create_row_identifier(row, REVENUE_ID_COLUMN)
-
-                # Convert empty strings to None for numeric fields
-                for key in REVENUE_NUMERIC_COLS:
-                    if row[key] == "":
-                        row[key] = None
-
-            res = soda.upsert(REV_DATASET, data)
+    files = list_s3_files(s3_client, "revenue/", selected_months)
+    snapshot_key = f"snapshots/{REV_DATASET}.parquet"
+    snapshot = read_snapshot(s3_client, snapshot_key, args.changed_only)
+    # The upsert batch size keeps adapting from one read batch and file to the next
+    upsert_batch_size = socrata_utils.BATCH_SIZE
+    for (f_year, f_month, f_department), f in sorted(files.items()):
+        batches = get_csv_data(
+            s3_client, f, REVENUE_FIELD_MAPPING, REVENUE_DTYPES, args.batch_size
+        )
+        for data in batches:
+            data = transform_batch(
+                data, f_year, f_month, f_department, REVENUE_ID_COLUMN, REVENUE_NUMERIC_COLS
+            )
+            if snapshot is not None:
+                # Only rows that are new or changed since the last run are sent to Socrata
+                data, digests = socrata_utils.changed_rows(data, "row_identifier", snapshot)
+                if not data:
+                    continue
+            res = socrata_utils.upsert_in_batches(
+                soda,
+                REV_DATASET,
+                data,
+                logger,
+                batch_size=upsert_batch_size,
+                workers=args.workers,
+                checkpoint_path=CHECKPOINT_PATH,
+                run_id=args.run_id,
+                s3_client=s3_client,
+                id_field="row_identifier",
+            )
+            res.pop("batches")
+            upsert_batch_size = res["batch_size"]
+            if snapshot is not None:
+                snapshot.update(digests)
             logger.info(f"Revenue Socrata Response: {f},{res}")
+    if snapshot is not None:
+        socrata_utils.write_snapshot(s3_client, BUCKET, snapshot_key, snapshot)
 
 
 if __name__ == "__main__":
@@ -213,8 +402,40 @@ if __name__ == "__main__":
         default=False,
     )
 
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=10000,
+        help="Number of rows read from each file at a time, which is also the most rows sent to Socrata "
+        "in one upsert batch, defaults to 10000",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=2,
+        help="Number of batches upserted to Socrata at the same time, defaults to 2",
+    )
+
+    parser.add_argument(
+        "--changed-only",
+        action="store_true",
+        help="Only upserts the rows that changed since the last --changed-only run, "
+        "using a snapshot of row digests kept in S3",
+    )
+
+    parser.add_argument(
+        "--run-id",
+        default=datetime.now().strftime("%Y-%m-%d"),
+        help="Identifies the run in the upsert checkpoints. Rerunning with the same run ID skips the batches "
+        "that were already upserted, defaults to today's date",
+    )
+
     args = parser.parse_args()
 
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
     logger = utils.get_logger(__name__, level=logging.INFO,)
 
     main(args)
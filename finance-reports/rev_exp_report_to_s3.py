@@ -1,19 +1,20 @@
 """
 Downloads two Microstrategy Reports for Expenses and Revenue. Places the results as a CSV in a S3 bucket.
-Runs the current month's report and last month's report.
+Runs the current month's report and last month's report, or backfills a range of months.
 """
 import argparse
 import calendar
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from io import StringIO
+import json
 import os
 import logging
+import threading
+import time
 
-import boto3
-from mstrio.api.reports import report_instance, get_prompted_instance
-from mstrio.project_objects.report import Report
-from mstrio.connection import Connection
-
+from common import s3_utils
+from config import EXPENSES_DTYPES
+from config import REVENUE_DTYPES
 import utils
 
 BASE_URL = os.getenv("BASE_URL")
@@ -26,16 +27,52 @@ AWS_ACCESS_ID = os.getenv("AWS_ACCESS_KEY")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 BUCKET = os.getenv("BUCKET_NAME")
 
+# Optional file to cache report prompt definitions between runs, and how long they are kept in seconds
+PROMPT_CACHE_PATH = os.getenv("PROMPT_CACHE_PATH")
+PROMPT_CACHE_TTL = int(os.getenv("PROMPT_CACHE_TTL", 24 * 60 * 60))
+
+# ATD = 2400, TPW = 6200
+DEPARTMENTS = ["2400", "6200"]
+
+# Reports with no rows are not uploaded, an empty object under this prefix records that they were run
+EMPTY_PREFIX = "empty/"
+
 EXP_REPORT_ID = "1C804F8891479811944EF68F99835649"
 REV_REPORT_ID = "FBC5E5F30744717D7079ADADB956C3BC"
 
-conn = Connection(
-    base_url=BASE_URL,
-    username=MSTRO_USERNAME,
-    password=MSTRO_PASSWORD,
-    project_id=PROJECT_ID,
-    login_mode=1,
-)
+# Microstrategy connection shared by the threads running reports, created by get_conn on first use
+conn = None
+conn_lock = threading.Lock()
+
+# Prompt definitions by report ID, shared by the threads running reports
+prompt_cache = {}
+prompt_cache_lock = threading.Lock()
+
+
+def get_conn():
+    """
+    Returns the Microstrategy connection, logging in the first time it is called
+
+    Returns
+    -------
+    mstrio Connection Object
+
+    """
+    global conn
+    with conn_lock:
+        if conn is None:
+            # mstrio and boto3 are slow to import, so they are imported where they are used
+            # and --help and argument errors return right away
+            from mstrio.connection import Connection
+
+            conn = Connection(
+                base_url=BASE_URL,
+                username=MSTRO_USERNAME,
+                password=MSTRO_PASSWORD,
+                project_id=PROJECT_ID,
+                login_mode=1,
+            )
+    return conn
 
 
 def select_month(year, month):
@@ -98,15 +135,13 @@ def build_todos(year, month, date_str):
         prev_year = year
 
     prev_date = get_month_date(prev_year, prev_month)
-    # ATD = 2400, TPW = 6200
-    departments = ["2400", "6200"]
     months = [prev_month, month]
     fys = [get_fiscal_year(prev_year, prev_month), get_fiscal_year(year, month)]
     dates = [prev_date, date_str]
 
     todos = []
     item = {}
-    for dept in departments:
+    for dept in DEPARTMENTS:
         for i in range(0, 2):
             item["department"] = dept
             item["month"] = months[i]
@@ -118,6 +153,81 @@ def build_todos(year, month, date_str):
     return todos
 
 
+def parse_month(value):
+    """
+    Parses a yyyy-mm string from the command line into a (year, month) tuple
+    """
+    try:
+        date = datetime.strptime(value, "%Y-%m")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not in the form yyyy-mm")
+    return date.year, date.month
+
+
+def build_range_todos(start, end):
+    """
+    Returns a list of dictionaries of required parameters to run microstrategy reports
+    for every month from start to end, including both
+
+    Parameters
+    ----------
+    start : (year, month) tuple of the first month
+    end : (year, month) tuple of the last month
+
+    """
+    months = []
+    year, month = start
+    while (year, month) <= end:
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    todos = []
+    for dept in DEPARTMENTS:
+        for year, month in months:
+            todos.append(
+                {
+                    "department": dept,
+                    "month": month,
+                    "fy": get_fiscal_year(year, month),
+                    "date": get_month_date(year, month),
+                }
+            )
+
+    return todos
+
+
+def report_filename(report, task):
+    """
+    Returns the S3 key of a report for a todo, without the file extension
+    """
+    return f"{REPORTS[report]['folder']}/{task['date']}_{task['department']}"
+
+
+def list_existing_reports(s3_client):
+    """
+    Returns the set of reports already run, as keys of their files in S3 without the file extension.
+    Reports that had no rows are found by their marker under EMPTY_PREFIX.
+
+    Parameters
+    ----------
+    s3_client : boto3 s3 client
+
+    """
+    existing = set()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for report in REPORTS.values():
+        for page in paginator.paginate(Bucket=BUCKET, Prefix=f"{report['folder']}/"):
+            for obj in page.get("Contents", []):
+                for ext in s3_utils.OUTPUT_FORMATS.values():
+                    if obj["Key"].endswith(ext):
+                        existing.add(obj["Key"][: -len(ext)])
+        prefix = f"{EMPTY_PREFIX}{report['folder']}/"
+        for page in paginator.paginate(Bucket=BUCKET, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                existing.add(obj["Key"][len(EMPTY_PREFIX) :])
+    return existing
+
+
 def expenses_prompts(fy, date, dept, prompts):
     """
     date must be in the form of yyyy-mm-dd
@@ -187,7 +297,25 @@ def revenue_prompts(fy, date, dept, prompts):
     return prompt_answers
 
 
-def get_report_data(prompt_answers, report_id, instance_id):
+def get_report_data(prompt_answers, report_id, instance_id, chunk_size=None):
+    """
+    Answers the prompts of a report instance and downloads the results
+
+    Parameters
+    ----------
+    prompt_answers : dict of the prompt answers
+    report_id : String of the Microstrategy report ID
+    instance_id : String of the report instance ID
+    chunk_size : Int number of rows per page, if given the results are downloaded one page at a time
+
+    Returns
+    -------
+    Pandas Dataframe, or a generator of Pandas Dataframes when chunk_size is given
+
+    """
+    from mstrio.project_objects.report import Report
+
+    conn = get_conn()
     # Send answers
     res = conn.put(
         url=conn.base_url
@@ -195,49 +323,131 @@ def get_report_data(prompt_answers, report_id, instance_id):
         json=prompt_answers,
     )
 
+    if chunk_size:
+        return get_report_chunks(report_id, instance_id, chunk_size)
+
     # Download report results to dataframe
     report = Report(conn, id=report_id, instance_id=instance_id)
     df = report.to_dataframe()
     return df
 
 
-def expense_data(fy, date_str, dept):
+def get_report_chunks(report_id, instance_id, chunk_size):
+    """
+    Yields the results of an answered report instance as dataframes of up to chunk_size rows,
+    so only one page of the report is held in memory at a time
+    """
+    from mstrio.api.reports import report_instance_id
+    from mstrio.utils.parser import Parser
+
+    conn = get_conn()
+    offset = 0
+    definition = None
+    while True:
+        page = report_instance_id(
+            conn,
+            report_id=report_id,
+            instance_id=instance_id,
+            offset=offset,
+            limit=chunk_size,
+        ).json()
+        # Later pages are parsed with the column definitions of the first page
+        definition = definition or page
+        parser = Parser(response=definition, parse_cube=False)
+        parser.parse(response=page)
+        yield parser.dataframe
+
+        paging = page["data"]["paging"]
+        offset += paging["current"]
+        if paging["current"] == 0 or offset >= paging["total"]:
+            break
+
+
+def get_prompts(report_id, instance_id):
+    """
+    Returns the prompt definitions of a report. The prompt and source IDs do not change between
+    report instances, so they are only fetched once per run and optionally cached on disk
+    at PROMPT_CACHE_PATH for PROMPT_CACHE_TTL seconds.
+
+    Parameters
+    ----------
+    report_id : String of the Microstrategy report ID
+    instance_id : String of a report instance ID, used when the prompts are not cached
+
+    Returns
+    -------
+    list of dicts of the prompts
+
+    """
+    with prompt_cache_lock:
+        if report_id in prompt_cache:
+            return prompt_cache[report_id]
+
+        disk_cache = {}
+        if PROMPT_CACHE_PATH and os.path.exists(PROMPT_CACHE_PATH):
+            with open(PROMPT_CACHE_PATH) as f:
+                disk_cache = json.load(f)
+        cached = disk_cache.get(report_id)
+        if cached and time.time() - cached["fetched_at"] < PROMPT_CACHE_TTL:
+            prompt_cache[report_id] = cached["prompts"]
+            return cached["prompts"]
+
+        from mstrio.api.reports import get_prompted_instance
+
+        prompts = get_prompted_instance(
+            get_conn(), report_id=report_id, instance_id=instance_id
+        ).json()
+        prompt_cache[report_id] = prompts
+
+        if PROMPT_CACHE_PATH:
+            disk_cache[report_id] = {"fetched_at": time.time(), "prompts": prompts}
+            with open(PROMPT_CACHE_PATH, "w") as f:
+                json.dump(disk_cache, f)
+
+    return prompts
+
+
+def expense_data(fy, date_str, dept, chunk_size=None):
+    from mstrio.api.reports import report_instance
+
     # Create report instance
-    instance_id = report_instance(conn, report_id=EXP_REPORT_ID).json()["instanceId"]
+    instance_id = report_instance(get_conn(), report_id=EXP_REPORT_ID).json()[
+        "instanceId"
+    ]
 
     # Get the prompts required by this report
     # Note that you can examine this json to see prompt format
-    prompts = get_prompted_instance(
-        conn, report_id=EXP_REPORT_ID, instance_id=instance_id
-    ).json()
+    prompts = get_prompts(EXP_REPORT_ID, instance_id)
 
     # Fill in prompt answers
     prompt_answers = expenses_prompts(fy, date_str, dept, prompts)
-    df = get_report_data(prompt_answers, EXP_REPORT_ID, instance_id)
+    df = get_report_data(prompt_answers, EXP_REPORT_ID, instance_id, chunk_size)
 
     return df
 
 
-def revenue_data(fy, date_str, dept):
+def revenue_data(fy, date_str, dept, chunk_size=None):
+    from mstrio.api.reports import report_instance
+
     # Create report instance
-    instance_id = report_instance(conn, report_id=REV_REPORT_ID).json()["instanceId"]
+    instance_id = report_instance(get_conn(), report_id=REV_REPORT_ID).json()[
+        "instanceId"
+    ]
 
     # Get the prompts required by this report
     # Note that you can examine this json to see prompt format
-    prompts = get_prompted_instance(
-        conn, report_id=REV_REPORT_ID, instance_id=instance_id
-    ).json()
+    prompts = get_prompts(REV_REPORT_ID, instance_id)
 
     # Fill in prompt answers
     prompt_answers = revenue_prompts(fy, date_str, dept, prompts)
-    df = get_report_data(prompt_answers, REV_REPORT_ID, instance_id)
+    df = get_report_data(prompt_answers, REV_REPORT_ID, instance_id, chunk_size)
 
     return df
 
 
-def df_to_s3(df, resource, filename):
+def df_to_s3(df, resource, filename, output_format="csv", dtypes=None):
     """
-    Send pandas dataframe to an S3 bucket as a CSV
+    Send pandas dataframe to an S3 bucket as a CSV, gzipped CSV or Parquet file
     h/t https://stackoverflow.com/questions/38154040/save-dataframe-to-csv-directly-to-s3-python
 
     Parameters
@@ -245,42 +455,178 @@ def df_to_s3(df, resource, filename):
     df : Pandas Dataframe
     resource : boto3 s3 resource
     filename : String of the file that will be created in the S3 bucket ex:
+    output_format : String, one of s3_utils.OUTPUT_FORMATS
+    dtypes : dict of column name: pandas dtype of the report columns, see s3_utils.serialize_df
+
+    Returns
+    -------
+    bool: True if the file was uploaded, False if it was unchanged
 
     """
     logger.info(f"Uploading {len(df)} rows to S3")
-    csv_buffer = StringIO()
-    df.to_csv(csv_buffer, index=False)
-    resource.Object(BUCKET, f"{filename}.csv").put(Body=csv_buffer.getvalue())
+    key = f"{filename}{s3_utils.OUTPUT_FORMATS[output_format]}"
+    body = s3_utils.serialize_df(df, output_format, dtypes=dtypes)
+    uploaded = s3_utils.put_if_changed(resource, BUCKET, key, body)
+    if not uploaded:
+        logger.info(f"{key} is unchanged, skipped upload")
+    return uploaded
 
 
-def main(args):
-    year, month = select_month(args.year, args.month)
-    logger.info(f"args: year = {year}, month = {month}")
-    date_str = get_month_date(year, month)
-    todos = build_todos(year, month, date_str)
+def stream_to_s3(dfs, resource, filename, output_format="csv"):
+    """
+    Sends a sequence of dataframes to an S3 bucket as one CSV or gzipped CSV. Each dataframe is
+    spooled to a temporary file as it arrives, so only one page of the report is held in memory.
+    Nothing is uploaded if there are no rows or the file is unchanged, see common.s3_utils.upload_spooled.
+
+    Parameters
+    ----------
+    dfs : iterable of Pandas Dataframes with the same columns
+    resource : boto3 s3 resource
+    filename : String of the file that will be created in the S3 bucket ex:
+    output_format : String, csv or csv.gz
+
+    Returns
+    -------
+    int: the number of rows in the file
+
+    """
+    key = f"{filename}{s3_utils.OUTPUT_FORMATS[output_format]}"
+    row_count = 0
+
+    def csv_chunks():
+        nonlocal row_count
+        for i, df in enumerate(dfs):
+            yield df.to_csv(index=False, header=i == 0).encode("utf-8")
+            row_count += len(df)
+
+    file, checksum = s3_utils.spool(
+        s3_utils.compress_chunks(csv_chunks(), output_format)
+    )
+    with file:
+        if row_count and not s3_utils.upload_spooled(
+            resource, BUCKET, key, file, checksum
+        ):
+            logger.info(f"{key} is unchanged, skipped upload")
+    return row_count
+
+
+# The data function, S3 folder and column dtypes of each report
+REPORTS = {
+    "Expenses": {"data": expense_data, "folder": "expenses", "dtypes": EXPENSES_DTYPES},
+    "Revenue": {"data": revenue_data, "folder": "revenue", "dtypes": REVENUE_DTYPES},
+}
+
+
+def run_report(report, task, args):
+    """
+    Downloads one report for a todo from build_todos and uploads it to S3
+
+    Parameters
+    ----------
+    report : String, a key of REPORTS
+    task : dict of the department, month, fy and date of the report
+    args : argparse Namespace of the CLI arguments
+
+    Returns
+    -------
+    int: the number of rows in the report
+
+    """
+    start = time.perf_counter()
+    logger.info(
+        f"Getting {report} Report for {task['date']} and department {task['department']}"
+    )
 
-    s3_resource = boto3.resource(
+    import boto3
+
+    # Each report gets its own session, creating resources from the shared default session is not thread safe
+    s3_resource = boto3.session.Session().resource(
         "s3",
         aws_access_key_id=AWS_ACCESS_ID,
         aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
     )
+    filename = report_filename(report, task)
 
-    for task in todos:
+    if args.stream:
+        # Each page is written out as it is downloaded
+        chunks = REPORTS[report]["data"](
+            task["fy"], task["date"], task["department"], args.chunk_size
+        )
+        row_count = stream_to_s3(chunks, s3_resource, filename, args.format)
+        if not row_count:
+            s3_resource.Object(BUCKET, f"{EMPTY_PREFIX}{filename}").put(Body=b"")
         logger.info(
-            f"Getting Expenses Report for {task['date']} and department {task['department']}"
+            f"{report} Report for {task['date']} and department {task['department']}: "
+            f"{row_count} rows streamed in {time.perf_counter() - start:.1f} s"
         )
-        filename = f"expenses/{task['date']}_{task['department']}"
-        df = expense_data(task["fy"], task["date"], task["department"])
-        if not df.empty:
-            df_to_s3(df, s3_resource, filename)
+        return row_count
 
-        logger.info(
-            f"Getting Revenue Report for {task['date']} and department {task['department']}"
+    df = REPORTS[report]["data"](task["fy"], task["date"], task["department"])
+    downloaded = time.perf_counter()
+
+    if df.empty:
+        s3_resource.Object(BUCKET, f"{EMPTY_PREFIX}{filename}").put(Body=b"")
+    else:
+        df_to_s3(df, s3_resource, filename, args.format, REPORTS[report]["dtypes"])
+
+    logger.info(
+        f"{report} Report for {task['date']} and department {task['department']}: "
+        f"{len(df)} rows, report {downloaded - start:.1f} s, "
+        f"upload {time.perf_counter() - downloaded:.1f} s"
+    )
+    return len(df)
+
+
+def main(args):
+    if args.start:
+        end = args.end or args.start
+        logger.info(f"args: backfill from {args.start} to {end}")
+        todos = build_range_todos(args.start, end)
+    else:
+        year, month = select_month(args.year, args.month)
+        logger.info(f"args: year = {year}, month = {month}")
+        date_str = get_month_date(year, month)
+        todos = build_todos(year, month, date_str)
+
+    jobs = [(report, task) for task in todos for report in REPORTS]
+    if args.start and not args.force:
+        import boto3
+
+        s3_client = boto3.client(
+            "s3",
+            aws_access_key_id=AWS_ACCESS_ID,
+            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
         )
-        filename = f"revenue/{task['date']}_{task['department']}"
-        df = revenue_data(task["fy"], task["date"], task["department"])
-        if not df.empty:
-            df_to_s3(df, s3_resource, filename)
+        existing = list_existing_reports(s3_client)
+        todo_jobs = [j for j in jobs if report_filename(*j) not in existing]
+        logger.info(f"Skipping {len(jobs) - len(todo_jobs)} reports already in S3")
+        jobs = todo_jobs
+
+    if jobs:
+        # Log in before starting the reports so a login failure stops the run right away
+        get_conn()
+
+    # Reports are run at the same time over the shared connection and uploaded as each one finishes
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(run_report, report, task, args): (report, task)
+            for report, task in jobs
+        }
+        for future in as_completed(futures):
+            report, task = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                failed.append(f"{report} {task['date']} {task['department']}")
+                logger.error(
+                    f"{report} Report for {task['date']} and department "
+                    f"{task['department']} failed with {e!r}"
+                )
+
+    logger.info(f"Finished {len(futures) - len(failed)} of {len(futures)} reports")
+    if failed:
+        raise RuntimeError(f"Reports failed: {', '.join(failed)}")
 
 
 if __name__ == "__main__":
@@ -299,8 +645,62 @@ if __name__ == "__main__":
         help=f"Calendar month of report. defaults to current month",
     )
 
+    parser.add_argument(
+        "--format",
+        choices=list(s3_utils.OUTPUT_FORMATS.keys()),
+        default="csv",
+        help="File format of the output in S3, defaults to csv",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of reports to run at the same time, defaults to 4",
+    )
+
+    parser.add_argument(
+        "--start",
+        type=parse_month,
+        help="First month to backfill in the form yyyy-mm, replaces --year and --month",
+    )
+
+    parser.add_argument(
+        "--end",
+        type=parse_month,
+        help="Last month to backfill in the form yyyy-mm, defaults to --start",
+    )
+
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Backfills reports that are already in S3, or were empty, instead of skipping them",
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Downloads reports one page at a time and spools each page to disk as it arrives",
+    )
+
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=50000,
+        help="Number of report rows per page when streaming, defaults to 50000",
+    )
+
     args = parser.parse_args()
 
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.stream and args.format == "parquet":
+        parser.error("--stream only supports the csv and csv.gz formats")
+    if args.end and not args.start:
+        parser.error("--end requires --start")
+    if args.start and args.end and args.end < args.start:
+        parser.error("--end must not be before --start")
+
     logger = utils.get_logger(__name__, level=logging.INFO,)
 
     main(args)
@@ -1,12 +1,16 @@
 """
 Summarizes data CSVs for ROW permits stored in S3 and publishes it to Socrata
 """
+import argparse
+
 import boto3
 import pandas as pd
 from sodapy import Socrata
 
 import os
 
+from common import s3_utils
+
 
 # AWS Credentials
 AWS_ACCESS_ID = os.getenv("EXEC_DASH_ACCESS_ID")
@@ -54,10 +58,34 @@ FILES = [
     },
 ]
 
+# Daily AMANDA files that the weekly files replace
+AMANDA_FILES = ["applications_received.csv", "issued_permits.csv"]
+
+# AMANDA counts already summed by week in the database, replaces the daily AMANDA files when used
+WEEKLY_FILES = [
+    {
+        "name": "Applications Received",
+        "fname": "applications_received_weekly.csv",
+        "date_col": "WEEK",
+        "count_col": "ISSUEDROWPERMITS",
+        "summary_cols": ["DS", "EX", "RW"],
+        "weekly": True,
+    },
+    {
+        "name": "Permits Issued",
+        "fname": "issued_permits_weekly.csv",
+        "date_col": "WEEK",
+        "count_col": "ISSUEDROWPERMITS",
+        "summary_cols": ["DS", "EX", "RW"],
+        "weekly": True,
+    },
+]
+
 
 def s3_to_df(s3, filename):
-    response = s3.get_object(Bucket=BUCKET, Key=filename)
-    return pd.read_csv(response.get("Body"))
+    key = s3_utils.find_key(s3, BUCKET, filename)
+    response = s3.get_object(Bucket=BUCKET, Key=key)
+    return s3_utils.read_df(response.get("Body"), key)
 
 
 def summarize_weekly(dfs):
@@ -88,8 +116,13 @@ def summarize_weekly(dfs):
             df = df.reset_index()
         # Convert date column to datetime type
         df[file["date_col"]] = pd.to_datetime(df[file["date_col"]])
-        # Grouping by week (starting on sunday)
-        week = df.resample("W-SAT", on=file["date_col"])[file["summary_cols"]].sum()
+        if file.get("weekly"):
+            # Already grouped by week in the database
+            week = df.set_index(file["date_col"])[file["summary_cols"]]
+            week.index.name = None
+        else:
+            # Grouping by week (starting on sunday)
+            week = df.resample("W-SAT", on=file["date_col"])[file["summary_cols"]].sum()
         week = pd.DataFrame(week)
         week["Measure"] = file["name"]
         weekly.append(week)
@@ -148,15 +181,20 @@ def df_to_socrata(soda, df):
     soda.replace(DATASET, payload)
 
 
-def main():
+def main(args):
     s3_client = boto3.client(
         "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS
     )
     soda = Socrata(SO_WEB, SO_TOKEN, username=SO_KEY, password=SO_SECRET, timeout=500,)
 
     # Load in data from S3
+    if args.weekly_queries:
+        files = WEEKLY_FILES + [f for f in FILES if f["fname"] not in AMANDA_FILES]
+    else:
+        files = FILES
+
     dfs = []
-    for f in FILES:
+    for f in files:
         row = f
         row["data"] = s3_to_df(s3_client, f["fname"])
         dfs.append(row)
@@ -169,4 +207,15 @@ def main():
     df_to_socrata(soda, weekly)
 
 if __name__ == "__main__":
-    main()
+    # CLI arguments definition
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--weekly-queries",
+        action="store_true",
+        help="Uses the AMANDA counts already summed by week instead of the daily counts",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
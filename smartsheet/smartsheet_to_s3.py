@@ -6,9 +6,13 @@ import boto3
 import pandas as pd
 import smartsheet
 
+import argparse
 import tempfile
-from io import StringIO
 import os
+import logging
+
+from common import s3_utils
+import utils
 
 FILES = [
     {
@@ -49,9 +53,9 @@ def df_groupby_date(df, date_column):
     return df
 
 
-def df_to_s3(df, resource, filename):
+def df_to_s3(df, resource, filename, output_format="csv"):
     """
-    Send pandas dataframe to an S3 bucket as a CSV
+    Send pandas dataframe to an S3 bucket as a CSV, gzipped CSV or Parquet file
     h/t https://stackoverflow.com/questions/38154040/save-dataframe-to-csv-directly-to-s3-python
 
     Parameters
@@ -59,14 +63,24 @@ def df_to_s3(df, resource, filename):
     df : Pandas Dataframe
     resource : boto3 s3 resource
     filename : String of the file that will be created in the S3 bucket ex:
+    output_format : String, one of s3_utils.OUTPUT_FORMATS
+
+    Returns
+    -------
+    bool: True if the file was uploaded, False if it was unchanged
 
     """
-    csv_buffer = StringIO()
-    df.to_csv(csv_buffer, index=True)
-    resource.Object(BUCKET, f"{filename}.csv").put(Body=csv_buffer.getvalue())
+    key = f"{filename}{s3_utils.OUTPUT_FORMATS[output_format]}"
+    body = s3_utils.serialize_df(df, output_format, index=True)
+    uploaded = s3_utils.put_if_changed(resource, BUCKET, key, body)
+    if uploaded:
+        logger.info(f"Uploaded {key} to S3")
+    else:
+        logger.info(f"{key} is unchanged, skipped upload")
+    return uploaded
 
 
-def main():
+def main(args):
     # Create a temporary directory where we will store the data from smartsheet
     temp_dir = tempfile.TemporaryDirectory()
 
@@ -80,10 +94,24 @@ def main():
         download_file(smart, f["id"], temp_dir, f["name"])
         df = pd.read_csv(f"{temp_dir.name}/{f['name']}.csv")
         df = df_groupby_date(df, f["date_column"])
-        df_to_s3(df, s3_resource, f["name"])
+        df_to_s3(df, s3_resource, f["name"], args.format)
 
     # Delete temporary directory
     temp_dir.cleanup()
 
 if __name__ == "__main__":
-    main()
+    # CLI arguments definition
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--format",
+        choices=list(s3_utils.OUTPUT_FORMATS.keys()),
+        default="csv",
+        help="File format of the output in S3, defaults to csv",
+    )
+
+    args = parser.parse_args()
+
+    logger = utils.get_logger(__name__, level=logging.INFO,)
+
+    main(args)
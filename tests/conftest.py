@@ -0,0 +1,122 @@
+from datetime import datetime, timedelta
+import hashlib
+import importlib
+import io
+import logging
+from pathlib import Path
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# The scripts import the shared helpers in common/ from the root of the repo, see the Dockerfile
+sys.path.insert(0, str(ROOT))
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+class FakeS3Client:
+    """In-memory stand-in for the parts of a boto3 s3 client that the scripts use"""
+
+    class exceptions:
+        NoSuchKey = NoSuchKey
+
+    def __init__(self):
+        self.objects = {}
+        self.metadata = {}
+        self.modified = {}
+        self.uploads = []
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise NoSuchKey(Key)
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body, Metadata=None):
+        self.objects[(Bucket, Key)] = Body.encode() if isinstance(Body, str) else Body
+        self.metadata[(Bucket, Key)] = Metadata or {}
+        # Every write is a second later than the one before it
+        self.modified[(Bucket, Key)] = datetime(2024, 1, 1) + timedelta(seconds=len(self.uploads))
+        self.uploads.append(Key)
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def list_objects_v2(self, Bucket, Prefix):
+        contents = [
+            {"Key": key, "LastModified": self.modified[(bucket, key)]}
+            for bucket, key in sorted(self.objects)
+            if bucket == Bucket and key.startswith(Prefix)
+        ]
+        return {"Contents": contents} if contents else {}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None):
+        self.put_object(Bucket, Key, Fileobj.read(), (ExtraArgs or {}).get("Metadata"))
+
+
+class FakeObject:
+    def __init__(self, client, bucket, key):
+        self.client = client
+        self.location = (bucket, key)
+
+    def load(self):
+        from botocore.exceptions import ClientError
+
+        if self.location not in self.client.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+
+    @property
+    def metadata(self):
+        return self.client.metadata[self.location]
+
+    @property
+    def e_tag(self):
+        return f'"{hashlib.md5(self.client.objects[self.location]).hexdigest()}"'
+
+    def get(self):
+        return self.client.get_object(Bucket=self.location[0], Key=self.location[1])
+
+    def put(self, Body, Metadata=None):
+        self.client.put_object(self.location[0], self.location[1], Body, Metadata)
+
+
+class FakeS3Resource:
+    """In-memory stand-in for the parts of a boto3 s3 resource that the scripts use"""
+
+    def __init__(self, client):
+        self.meta = type("Meta", (), {"client": client})
+
+    def Object(self, bucket, key):
+        return FakeObject(self.meta.client, bucket, key)
+
+
+@pytest.fixture
+def s3_client():
+    return FakeS3Client()
+
+
+@pytest.fixture
+def s3_resource(s3_client):
+    return FakeS3Resource(s3_client)
+
+
+@pytest.fixture
+def load_script(monkeypatch):
+    """
+    Returns a function that imports a script from its directory. Each directory has its own utils
+    module, so the ones imported by other tests are cleared first.
+    """
+
+    def load(directory, name):
+        monkeypatch.syspath_prepend(str(ROOT / directory))
+        for module in ["utils", "config", name]:
+            monkeypatch.delitem(sys.modules, module, raising=False)
+        module = importlib.import_module(name)
+        # The scripts only create their logger when run from the command line
+        monkeypatch.setattr(module, "logger", logging.getLogger(name), raising=False)
+        return module
+
+    return load
@@ -0,0 +1,73 @@
+from datetime import datetime
+import gzip
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("boto3")
+pytest.importorskip("cx_Oracle")
+
+
+class FakeCursor:
+    """Stand-in for a cx_Oracle cursor that has executed a query"""
+
+    def __init__(self, columns, rows):
+        self.description = [(col,) for col in columns]
+        self.rows = list(rows)
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+@pytest.fixture
+def amanda(load_script, monkeypatch):
+    module = load_script("AMANDA", "amanda_to_s3")
+    monkeypatch.setattr(module, "BUCKET", "bucket")
+    return module
+
+
+def test_stream_to_s3(amanda, s3_client, s3_resource):
+    rows = [(i, f"permit {i}") for i in range(5)]
+    count = amanda.stream_to_s3(FakeCursor(["ID", "NAME"], rows), s3_resource, "permits", 2)
+    assert count == 5
+    expected = "ID,NAME\n" + "".join(f"{i},permit {i}\n" for i in range(5))
+    assert s3_client.objects[("bucket", "permits.csv")].decode() == expected
+
+    # The same results are not uploaded again
+    amanda.stream_to_s3(FakeCursor(["ID", "NAME"], rows), s3_resource, "permits", 2)
+    assert s3_client.uploads == ["permits.csv"]
+
+    amanda.stream_to_s3(FakeCursor(["ID", "NAME"], rows), s3_resource, "permits", 2, "csv.gz")
+    assert gzip.decompress(s3_client.objects[("bucket", "permits.csv.gz")]).decode() == expected
+
+
+def test_stream_to_s3_without_rows(amanda, s3_client, s3_resource):
+    assert amanda.stream_to_s3(FakeCursor(["ID", "NAME"], []), s3_resource, "permits", 2) == 0
+    assert s3_client.objects[("bucket", "permits.csv")] == b"ID,NAME\n"
+
+
+def test_watermark_round_trip(amanda, s3_resource):
+    query = "applications_received"
+    date_col = amanda.INCREMENTAL_QUERIES[query]["date_col"]
+    assert amanda.get_watermark(s3_resource, query) == {}
+
+    full_refresh = datetime(2024, 1, 6, 2, 30)
+    df = pd.DataFrame({date_col: ["2024-01-02", "2024-01-05", None]})
+    amanda.set_watermark(s3_resource, query, df, full_refresh)
+    expected = {"watermark": datetime(2024, 1, 5), "full_refresh": full_refresh}
+    assert amanda.get_watermark(s3_resource, query) == expected
+
+    # An empty result keeps the stored watermark instead of writing NaN
+    df = pd.DataFrame({date_col: pd.Series([], dtype=object)})
+    amanda.set_watermark(s3_resource, query, df, datetime(2024, 2, 1))
+    assert amanda.get_watermark(s3_resource, query) == expected
+
+
+def test_incremental_update_without_stored_file(amanda, s3_resource):
+    # The watermark can outlive the file, for example after changing --format
+    cursor = FakeCursor(["FOLDERTYPE"], [])
+    result = amanda.incremental_update(
+        cursor, s3_resource, "applications_received", datetime(2024, 1, 5), 7, "csv.gz"
+    )
+    assert result is None
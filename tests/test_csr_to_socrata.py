@@ -0,0 +1,89 @@
+from datetime import datetime
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+np = pytest.importorskip("numpy")
+pytest.importorskip("pyproj")
+pytest.importorskip("sodapy")
+pytest.importorskip("boto3")
+
+
+@pytest.fixture
+def csr(load_script, monkeypatch):
+    module = load_script("csr", "csr_to_socrata")
+    monkeypatch.setattr(module, "BUCKET", "bucket")
+    monkeypatch.setattr(module, "DATASET", "abcd-1234")
+    return module
+
+
+def test_coordinate_cache_hit_and_miss(csr, s3_client, monkeypatch):
+    def csrs(xs, ys):
+        return pd.DataFrame({"State Plane X Coordinate": xs, "State Plane Y Coordinate": ys})
+
+    cache = csr.read_coordinate_cache(s3_client)
+    first = csr.convert_from_state_plane(csrs([3110000.0, 3120000.0], [10070000.0, 10080000.0]), cache)
+    csr.write_coordinate_cache(s3_client, cache)
+
+    projected = []
+    project = csr.project
+    monkeypatch.setattr(csr, "project", lambda x, y: (projected.append(x.tolist()), project(x, y))[1])
+
+    cache = csr.read_coordinate_cache(s3_client)
+    second = csr.convert_from_state_plane(csrs([3110000.0, 3130000.0], [10070000.0, 10090000.0]), cache)
+    assert projected == [[3130000.0]]
+    assert second["location"][0] == first["location"][0]
+
+    # Coordinates that no CSR of the run has anymore are dropped
+    csr.write_coordinate_cache(s3_client, cache)
+    cache = csr.read_coordinate_cache(s3_client)
+    assert sorted(cache["previous"].index.get_level_values("x")) == [3110000.0, 3130000.0]
+
+
+def test_get_fiscal_years(csr):
+    dates = pd.Series(pd.to_datetime(["2023-09-30", "2023-10-01", "2024-12-31"]))
+    assert csr.get_fiscal_years(dates).tolist() == [2023, 2024, 2025]
+    assert csr.get_fiscal_years(dates).tolist() == [
+        csr.get_fiscal_year({"datetime": date}) for date in dates
+    ]
+
+
+def test_build_points(csr):
+    latitude = pd.Series([30.25, np.nan, 30.5])
+    longitude = pd.Series([-97.75, -97.7, np.nan])
+    assert csr.build_points(latitude, longitude).tolist() == ["POINT (-97.75 30.25)", None, None]
+    row = {"latitude": 30.25, "longitude": -97.75}
+    assert csr.build_points(latitude, longitude)[0] == csr.build_point_data(row)
+
+
+def test_watermark_round_trip(csr, s3_client):
+    assert csr.get_watermark(s3_client) == {}
+    watermark = {
+        "last_update_date": datetime(2024, 1, 5, 13, 30),
+        "full_reconcile": datetime(2024, 1, 1),
+    }
+    csr.set_watermark(s3_client, watermark)
+    assert csr.get_watermark(s3_client) == watermark
+
+
+def test_updated_since(csr):
+    df = pd.DataFrame({"Last Update Date": pd.to_datetime(["2024-01-02", "2023-12-01", None])})
+    latest = []
+    # CSRs without a Last Update Date are kept
+    assert len(csr.updated_since(df, datetime(2024, 1, 1), latest)) == 2
+    assert latest == [pd.Timestamp("2024-01-02")]
+
+    # Without any dates there is nothing to move the watermark to
+    df = pd.DataFrame({"Last Update Date": pd.Series([pd.NaT, pd.NaT], dtype="datetime64[ns]")})
+    latest = []
+    assert len(csr.updated_since(df, datetime(2024, 1, 1), latest)) == 2
+    assert latest == []
+
+
+def test_parse_date_column_falls_back_to_inference(csr):
+    values = pd.Series(["01/02/2024 03:04:05 PM", "2024-01-03T10:00:00", None])
+    parsed = csr.parse_date_column(values)
+    assert parsed[0] == pd.Timestamp("2024-01-02 15:04:05")
+    # Dates in another format are inferred instead of being dropped
+    assert parsed[1] == pd.Timestamp("2024-01-03 10:00:00")
+    assert pd.isna(parsed[2])
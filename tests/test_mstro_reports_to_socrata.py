@@ -0,0 +1,49 @@
+import gzip
+
+import pytest
+
+
+@pytest.fixture
+def mstro(load_script):
+    return load_script("finance-reports", "mstro_reports_to_socrata")
+
+
+def test_transform_batch(mstro):
+    data = [
+        {"fund": "8100", "unit": "2400", "amount": "12.50"},
+        {"fund": "8100", "unit": None, "amount": ""},
+    ]
+    rows = mstro.transform_batch(data, 2023, 10, 2400, ["fund", "unit"], ["amount"])
+    assert rows[0] == {
+        "fund": "8100",
+        "unit": "2400",
+        "amount": "12.50",
+        "year": 2023,
+        "month": 10,
+        "department": 2400,
+        "month_name": "Oct",
+        "fiscal_year": 2024,
+        "fiscal_month": 1,
+        "row_identifier": "81002400",
+    }
+    assert rows[1]["amount"] is None
+    assert rows[1]["row_identifier"] == mstro.create_row_identifier(rows[1], ["fund", "unit"])
+
+
+def test_build_projection(mstro):
+    project = mstro.build_projection(["b", "a", "extra"], {"a": "col_a", "b": "col_b", "missing": "col_m"})
+    assert project(["1", "2", "3"]) == {"col_a": "2", "col_b": "1", "col_m": None}
+    # Short rows are padded with None
+    assert project(["1"]) == {"col_a": None, "col_b": "1", "col_m": None}
+
+
+@pytest.mark.parametrize("key", ["expenses/2023-09-30_2400.csv", "expenses/2023-09-30_2400.csv.gz"])
+def test_get_csv_data_batches(mstro, s3_client, monkeypatch, key):
+    monkeypatch.setattr(mstro, "BUCKET", "bucket")
+    body = "Fund,Amount\n" + "".join(f"{i},{i}.5\n" for i in range(5))
+    body = body.encode()
+    s3_client.put_object("bucket", key, gzip.compress(body) if key.endswith(".gz") else body)
+
+    batches = list(mstro.get_csv_data(s3_client, key, {"Fund": "fund", "Amount": "amount"}, {}, 2))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert batches[2] == [{"fund": "4", "amount": "4.5"}]
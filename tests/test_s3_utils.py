@@ -0,0 +1,82 @@
+import gzip
+import hashlib
+import io
+
+import pytest
+
+# stored_checksum_matches tells missing objects apart with botocore's ClientError
+pytest.importorskip("botocore")
+
+from common import s3_utils
+
+
+def test_put_if_changed(s3_client, s3_resource):
+    assert s3_utils.put_if_changed(s3_resource, "bucket", "a.csv", "id\n1\n")
+    assert s3_client.metadata[("bucket", "a.csv")] == {"sha256": hashlib.sha256(b"id\n1\n").hexdigest()}
+    assert not s3_utils.put_if_changed(s3_resource, "bucket", "a.csv", b"id\n1\n")
+    assert s3_utils.put_if_changed(s3_resource, "bucket", "a.csv", "id\n2\n")
+    assert s3_client.uploads == ["a.csv", "a.csv"]
+
+
+def test_put_if_changed_compares_etag_without_checksum(s3_client, s3_resource):
+    # Objects uploaded before checksums were stored have no metadata
+    s3_client.put_object("bucket", "a.csv", b"id\n1\n")
+    assert not s3_utils.put_if_changed(s3_resource, "bucket", "a.csv", b"id\n1\n")
+    assert s3_utils.put_if_changed(s3_resource, "bucket", "a.csv", b"id\n2\n")
+
+
+def test_compress_chunks():
+    chunks = [b"id,name\n", b"1,a\n", b"2,b\n"]
+    assert list(s3_utils.compress_chunks(chunks, "csv")) == chunks
+    compressed = b"".join(s3_utils.compress_chunks(chunks, "csv.gz"))
+    assert gzip.decompress(compressed) == b"".join(chunks)
+    # No timestamp in the header, so the same data always gives the same file
+    assert compressed == b"".join(s3_utils.compress_chunks(chunks, "csv.gz"))
+
+
+def test_upload_stream(s3_client, s3_resource):
+    chunks = [b"id\n", b"1\n"]
+    assert s3_utils.upload_stream(s3_resource, "bucket", "a.csv", iter(chunks))
+    assert s3_client.objects[("bucket", "a.csv")] == b"id\n1\n"
+    assert s3_client.metadata[("bucket", "a.csv")] == {"sha256": hashlib.sha256(b"id\n1\n").hexdigest()}
+    # The checksum is known before anything is sent, so an unchanged file is not uploaded
+    assert not s3_utils.upload_stream(s3_resource, "bucket", "a.csv", iter(chunks))
+    assert s3_client.uploads == ["a.csv"]
+
+
+@pytest.mark.parametrize("output_format", ["csv", "csv.gz", "parquet"])
+def test_serialize_and_read_df(output_format):
+    pd = pytest.importorskip("pandas")
+    if output_format == "parquet":
+        pytest.importorskip("pyarrow")
+
+    df = pd.DataFrame({"id": [123, 456], "name": ["a", None], "amount": [1.5, None]})
+    key = f"report{s3_utils.OUTPUT_FORMATS[output_format]}"
+    body = s3_utils.serialize_df(df, output_format, dtypes={"name": "string"})
+
+    result = s3_utils.read_df(io.BytesIO(body), key, dtype={"id": str, "name": str})
+    assert result["id"].tolist() == ["123", "456"]
+    assert result["name"][0] == "a" and pd.isna(result["name"][1])
+    assert result["amount"][0] == 1.5 and pd.isna(result["amount"][1])
+
+
+def test_read_df_parquet_ids_with_missing_values():
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("pyarrow")
+
+    # Parquet stores whole numbers with missing values as floats
+    body = s3_utils.serialize_df(pd.DataFrame({"id": [123, None]}), "parquet")
+    result = s3_utils.read_df(io.BytesIO(body), "report.parquet", dtype={"id": str})
+    assert result["id"][0] == "123"
+    assert pd.isna(result["id"][1])
+
+
+def test_find_key(s3_client):
+    assert s3_utils.find_key(s3_client, "bucket", "report.csv") == "report.csv"
+    s3_client.put_object("bucket", "report.csv", b"")
+    s3_client.put_object("bucket", "report.parquet", b"")
+    s3_client.put_object("bucket", "report_2.csv", b"")
+    # The most recently written version wins
+    assert s3_utils.find_key(s3_client, "bucket", "report.csv") == "report.parquet"
+    s3_client.put_object("bucket", "report.csv.gz", b"")
+    assert s3_utils.find_key(s3_client, "bucket", "report.csv") == "report.csv.gz"
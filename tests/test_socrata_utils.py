@@ -0,0 +1,100 @@
+import logging
+
+import pytest
+
+# send_batch retries the errors raised by requests
+pytest.importorskip("requests")
+
+from common import socrata_utils
+
+
+class FakeSoda:
+    def __init__(self, fail_at=None):
+        self.batches = []
+        self.fail_at = fail_at
+
+    def upsert(self, dataset, rows):
+        if self.fail_at is not None and len(self.batches) == self.fail_at:
+            raise RuntimeError("Socrata went away")
+        self.batches.append(rows)
+        return {"Rows Updated": len(rows)}
+
+
+def test_merge_ranges():
+    assert socrata_utils.merge_ranges([]) == []
+    assert socrata_utils.merge_ranges([[10, 20], [0, 5], [5, 8], [15, 30], [40, 50]]) == [
+        [0, 8],
+        [10, 30],
+        [40, 50],
+    ]
+
+
+def test_dedupe_rows_keeps_last_row_of_each_id():
+    payload = [{"id": 1, "v": "a"}, {"id": 2, "v": "b"}, {"id": 1, "v": "c"}]
+    assert socrata_utils.dedupe_rows(payload, "id") == [{"id": 2, "v": "b"}, {"id": 1, "v": "c"}]
+
+
+def test_batch_size_carries_over_between_calls():
+    logger = logging.getLogger("test")
+    payload = [{"id": i} for i in range(3000)]
+    soda = FakeSoda()
+    res = socrata_utils.upsert_in_batches(soda, "abcd-1234", payload, logger, batch_size=1000, id_field="id")
+    # Fast batches grow by half each time
+    assert res["batch_size"] > 1000
+
+    payload = [{"id": i} for i in range(10000)]
+    soda = FakeSoda()
+    socrata_utils.upsert_in_batches(
+        soda, "abcd-1234", payload, logger, batch_size=res["batch_size"], id_field="id"
+    )
+    assert len(soda.batches[0]) == res["batch_size"]
+
+
+def test_row_digest():
+    assert socrata_utils.row_digest({"a": 1, "b": "x"}) == socrata_utils.row_digest({"b": "x", "a": 1})
+    assert socrata_utils.row_digest({"a": 1, "b": "x"}) != socrata_utils.row_digest({"a": 1, "b": "y"})
+    # The dtype pandas inferred for a chunk does not change the digest
+    assert socrata_utils.row_digest({"a": 64.0, "b": float("nan")}) == socrata_utils.row_digest({"a": 64, "b": None})
+    assert socrata_utils.row_digest({"a": 64.5}) != socrata_utils.row_digest({"a": 64})
+
+
+def test_changed_rows():
+    old = [{"id": 1, "v": "a"}, {"id": 2, "v": "b"}]
+    _, snapshot = socrata_utils.changed_rows(old, "id", {})
+    assert set(snapshot) == {"1", "2"}
+
+    new = [{"id": 1.0, "v": "a"}, {"id": 2, "v": "changed"}, {"id": 3, "v": "new"}]
+    rows, digests = socrata_utils.changed_rows(new, "id", snapshot)
+    assert rows == new[1:]
+    assert set(digests) == {"2", "3"}
+
+
+@pytest.mark.parametrize("s3", [False, True])
+def test_upsert_resumes_from_checkpoint_and_deletes_it(tmp_path, s3_client, s3):
+    logger = logging.getLogger("test")
+    payload = [{"id": i} for i in range(10)]
+    kwargs = {
+        "batch_size": 3,
+        "workers": 1,
+        "checkpoint_path": "s3://bucket/checkpoints" if s3 else str(tmp_path),
+        "run_id": "run",
+        "s3_client": s3_client,
+        "id_field": "id",
+    }
+
+    def checkpoints():
+        return list(s3_client.objects) if s3 else list(tmp_path.rglob("*.json"))
+
+    # The first batch is acknowledged, then the rest of the payload fails
+    soda = FakeSoda(fail_at=1)
+    with pytest.raises(RuntimeError):
+        socrata_utils.upsert_in_batches(soda, "abcd-1234", payload, logger, **kwargs)
+    assert len(soda.batches) == 1
+    assert checkpoints()
+
+    soda = FakeSoda()
+    res = socrata_utils.upsert_in_batches(soda, "abcd-1234", payload, logger, **kwargs)
+    assert [row["id"] for batch in soda.batches for row in batch] == list(range(3, 10))
+    assert res["rows"] == 7
+    assert not checkpoints()
+    assert not list(tmp_path.iterdir())